@@ -0,0 +1,300 @@
+#!/usr/bin/python
+
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is released under the standard PSF license.
+
+"""
+Benchmarks for the hot paths of command.py, on synthetic command trees.
+
+Run from the top of the source tree:
+
+  python bench/benchmark.py --output results.json
+  python bench/benchmark.py --baseline bench/baseline.json
+
+Results are the best time per operation over a number of repeats, in
+seconds, and are compared against the baseline if one is given; the
+exit code is 1 if any benchmark got slower than the threshold allows.
+
+The manhole.line benchmark, of a line pushed to the interpreter of a
+manhole shell, only runs when Twisted is installed.
+
+Times depend on the machine, so regenerate the baseline with --output on
+the machine you compare on, before making changes.  The output records
+the tree and repeat parameters, and a baseline made with different ones
+is refused.
+"""
+
+import os
+import sys
+import gc
+import time
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from command import command
+
+
+def generateTree(width, depth, options=0, aliases=0, lazy=False):
+    """
+    Generate the class of the root of a synthetic command tree, with
+    width subcommands per command down to the given depth.
+
+    Subcommands are named n0, n1, ...; their aliases a0n0, a1n0, ...;
+    and the leaves' do() writes their name.
+    """
+
+    def addOptions(self):
+        for i in range(options):
+            self.parser.add_option('--option%d' % i,
+                action="store", dest="option%d" % i,
+                help="option %d of %s" % (i, self.name))
+
+    def do(self, args):
+        self.stdout.write(self.name + '\n')
+
+    def generate(name, level):
+        attributes = {
+            'name': name,
+            'summary': 'Synthetic command %s' % name,
+            'aliases': ['a%d%s' % (i, name) for i in range(aliases)],
+            'lazySubCommands': lazy,
+            'addOptions': addOptions,
+        }
+        if level < depth:
+            attributes['subCommandClasses'] = [
+                generate('n%d' % i, level + 1) for i in range(width)]
+        else:
+            attributes['do'] = do
+        return type('Synthetic_%s_%d' % (name, level), (command.Command, ),
+            attributes)
+
+    return generate('root', 0)
+
+
+def best(function, repeat, number):
+    """
+    Return the best time per call of function, over repeat runs of
+    number calls.
+    """
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.time()
+        for j in range(number):
+            function()
+        times.append((time.time() - start) / number)
+    return min(times)
+
+
+def _getRSS():
+    # resident memory in bytes, on Linux
+    handle = open('/proc/self/statm')
+    try:
+        return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        handle.close()
+
+
+def measureMemory(klass):
+    """
+    Return the number of objects and bytes of resident memory a
+    constructed tree takes, measured in a child process.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        gc.collect()
+        objects = len(gc.get_objects())
+        rss = _getRSS()
+        root = klass(stdout=StringIO.StringIO())
+        root.parser
+        gc.collect()
+        os.write(write, '%d %d' % (len(gc.get_objects()) - objects,
+            _getRSS() - rss))
+        os._exit(0)
+
+    os.close(write)
+    result = os.read(read, 100)
+    os.close(read)
+    os.waitpid(pid, 0)
+    objects, rss = result.split()
+    return int(objects), int(rss)
+
+
+def run(width, depth, options, aliases, repeat):
+    """
+    Run all benchmarks.
+
+    @rtype: dict of str -> float
+    """
+    results = {}
+    out = StringIO.StringIO()
+    deep = ['n0'] * depth
+
+    for lazy in (False, True):
+        mode = lazy and 'lazy' or 'eager'
+        klass = generateTree(width, depth, options, aliases, lazy)
+
+        results['construct.%s' % mode] = best(
+            lambda: klass(stdout=out), repeat, 3)
+        results['memory.%s.objects' % mode], \
+            results['memory.%s.rss' % mode] = measureMemory(klass)
+
+        # a new tree every time, like a command line invocation
+        results['invocation.%s' % mode] = best(
+            lambda: klass(stdout=out, stderr=out).parse(deep), repeat, 3)
+
+        # a constructed tree, like a shell or batch
+        root = klass(stdout=out, stderr=out)
+        results['dispatch.%s' % mode] = best(
+            lambda: root.parse(deep), repeat, 100)
+
+    root = klass(stdout=out, stderr=out)
+    results['help.first'] = best(
+        lambda: klass(stdout=out, stderr=out).parse(['--help']), repeat, 3)
+    results['help.repeated'] = best(
+        lambda: root.parse(['--help']), repeat, 100)
+    results['unknown'] = best(
+        lambda: root.parse(['unknown']), repeat, 100)
+    results['help.leaf'] = best(
+        lambda: root.parse(deep + ['--help']), repeat, 100)
+
+    # the class is cached on the command, so use a new tree every time;
+    # this includes constructing the lazy root
+    results['shell.class'] = best(
+        lambda: command.commandToCmdClass(klass(stdout=out)), repeat, 3)
+    shell = command.commandToCmdClass(root)(stdout=out)
+    line = ' '.join(deep)
+    results['shell.line'] = best(
+        lambda: shell.onecmd(line), repeat, 100)
+
+    try:
+        from command import manholecmd
+    except ImportError:
+        # needs Twisted
+        return results
+
+    class Handler:
+        terminal = out
+
+    class Interpreter(manholecmd.CmdInterpreter):
+        cmdClass = command.commandToCmdClass(root)
+
+    interpreter = Interpreter(Handler())
+    results['manhole.line'] = best(
+        lambda: interpreter.push(line), repeat, 100)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Compare results against a baseline.
+
+    @rtype:   list of (str, float, float, float)
+    @returns: the name, baseline, result and ratio of benchmarks that got
+              slower than the threshold allows.
+    """
+    regressions = []
+    for name in sorted(results.keys()):
+        if name not in baseline or not baseline[name]:
+            continue
+        ratio = float(results[name]) / baseline[name]
+        if ratio > threshold:
+            regressions.append((name, baseline[name], results[name], ratio))
+
+    return regressions
+
+
+class Benchmark(command.Command):
+    usage = "[options]"
+    description = """Run benchmarks for command.py on synthetic command trees.
+
+Results are the best time per operation in seconds, or counts for
+memory.  With a baseline, benchmarks that got slower than the threshold
+are listed, and the exit code is 1."""
+
+    def addOptions(self):
+        self.parser.add_option('-w', '--width',
+            action="store", dest="width", type="int", default=10,
+            help="subcommands per command (default %default)")
+        self.parser.add_option('-d', '--depth',
+            action="store", dest="depth", type="int", default=3,
+            help="levels of subcommands (default %default)")
+        self.parser.add_option('-p', '--options',
+            action="store", dest="options", type="int", default=5,
+            help="options per command (default %default)")
+        self.parser.add_option('-a', '--aliases',
+            action="store", dest="aliases", type="int", default=1,
+            help="aliases per command (default %default)")
+        self.parser.add_option('-r', '--repeat',
+            action="store", dest="repeat", type="int", default=5,
+            help="repeats; the best is kept (default %default)")
+        self.parser.add_option('-o', '--output',
+            action="store", dest="output", metavar="FILE",
+            help="write the results as JSON to FILE")
+        self.parser.add_option('-b', '--baseline',
+            action="store", dest="baseline", metavar="FILE",
+            help="compare against the JSON results in FILE")
+        self.parser.add_option('-t', '--threshold',
+            action="store", dest="threshold", type="float", default=1.5,
+            help="slowdown ratio counted as a regression (default %default)")
+
+    def do(self, args):
+        import json
+
+        o = self.options
+        parameters = {
+            'width': o.width,
+            'depth': o.depth,
+            'options': o.options,
+            'aliases': o.aliases,
+            'repeat': o.repeat,
+        }
+        results = run(o.width, o.depth, o.options, o.aliases, o.repeat)
+
+        for name in sorted(results.keys()):
+            self.stdout.write('%-24s %g\n' % (name, results[name]))
+
+        if o.output:
+            handle = open(o.output, 'w')
+            try:
+                json.dump({'parameters': parameters, 'results': results},
+                    handle, indent=4, sort_keys=True)
+            finally:
+                handle.close()
+
+        if not o.baseline:
+            return 0
+
+        handle = open(o.baseline)
+        try:
+            baseline = json.load(handle)
+        finally:
+            handle.close()
+
+        # results on another tree can not be compared
+        if baseline.get('parameters') != parameters:
+            describe = lambda p: ' '.join(['%s=%s' % (k, p[k])
+                for k in sorted(p.keys())])
+            self.stderr.write("%s was made with %s, not %s.\n" % (
+                o.baseline, describe(baseline.get('parameters', {})) or
+                    "unknown parameters", describe(parameters)))
+            return 3
+
+        regressions = compare(results, baseline['results'], o.threshold)
+        for name, before, after, ratio in regressions:
+            self.stderr.write('%s: %g -> %g (%.2fx)\n' % (
+                name, before, after, ratio))
+        if regressions:
+            return 1
+
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(Benchmark().parse(sys.argv[1:]))
@@ -0,0 +1,132 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+"""
+Helper classes for asyncio commands.
+
+On Python 2, the trollius backport of asyncio is used.
+"""
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import command
+
+
+class AsyncCommand(command.Command):
+    """
+    I am a Command that integrates with asyncio and its event loop.
+
+    Instead of implementing the do() method, subclasses should implement a
+    doLater() coroutine function, for example an async def method.
+    """
+
+    def getLoop(self):
+        """
+        Return the event loop of the ancestor LoopCommand.
+        """
+        c = self
+        while c and not isinstance(c, LoopCommand):
+            c = c.parentCommand
+
+        if not c:
+            raise AssertionError(
+                '%r does not have a parent LoopCommand' % self)
+
+        return c.getLoop()
+
+    ### command.Command implementations
+    def do(self, args):
+        loop = self.getLoop()
+        self.debug('%r: scheduling doLater on loop %r', self, loop)
+
+        # a task, so the ancestor LoopCommand can recognize it
+        return loop.create_task(self.doLater(args))
+
+    ### command.AsyncCommand methods to implement by subclasses
+    def doLater(self, args):
+        """
+        @rtype: coroutine
+        """
+        raise NotImplementedError
+
+
+class LoopCommand(command.Command):
+    """
+    I am a Command that owns an event loop, and runs it for my subcommands
+    until the task returned from their do() method is done.
+
+    Unlike a Twisted reactor, the loop can be run again, so I can parse
+    any number of times.  Call close() when done.
+    """
+
+    loop = None
+
+    def createLoop(self):
+        """
+        Override me to create your own event loop.
+        """
+        return asyncio.new_event_loop()
+
+    def getLoop(self):
+        if self.loop is None:
+            self.loop = self.createLoop()
+            # so coroutines that use the default loop use ours
+            asyncio.set_event_loop(self.loop)
+            self.debug('LoopCommand: created loop %r', self.loop)
+
+        return self.loop
+
+    def close(self):
+        """
+        Close the event loop.
+        """
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+            asyncio.set_event_loop(None)
+
+    ### command.Command overrides
+
+    def parse(self, argv):
+        """
+        I will run the event loop to get the result of a task.
+        """
+        self.debug('parse: chain up')
+        r = command.Command.parse(self, argv)
+        self.debug('parse: result %r', r)
+
+        # if it's not a future, return the result as is
+        if not isinstance(r, asyncio.Future):
+            return r
+
+        # with --json, the root already emitted the output as a record;
+        # it forgets about --json once the task is done, so ask now
+        structured = self.isStructured()
+
+        loop = self.getLoop()
+        self.debug('running loop %r', loop)
+        try:
+            ret = loop.run_until_complete(r)
+        except command.CommandOk, e:
+            self.debug('done with exception, raised %r', e)
+            if e.output is not None and not structured:
+                self.stdout.write(e.output + '\n')
+            return e.status
+        except command.CommandExited, e:
+            self.debug('done with exception, raised %r', e)
+            if e.output is not None and not structured:
+                self.stderr.write(e.output + '\n')
+            return e.status
+        except Exception, e:
+            self.warning('exception: %r', e)
+            self.stderr.write('Failure: %s\n' % e)
+            raise
+
+        if ret is None:
+            self.debug('parse returned None, defaults to exit code 0')
+            ret = 0
+        self.debug('ran loop, returning %r', ret)
+        return ret
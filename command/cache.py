@@ -0,0 +1,386 @@
+# -*- Mode: Python; test-case-name: test_cache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is released under the standard PSF license.
+
+"""
+An on-disk cache of the metadata of a command tree.
+
+The cache stores names, aliases, summaries, usage, help output and option
+specifications of every command in a tree, together with the modification
+times of the modules implementing them.  With a valid cache, help output,
+unknown command errors and dispatch routing can be handled without
+importing or instantiating the command tree.
+
+Example use in a program's main function:
+
+>>> def main():
+...     return cache.main('myproject.main:Root', '~/.cache/myproject.json')
+"""
+
+import os
+import sys
+
+import command
+
+# bump when the format of the snapshot changes
+VERSION = 2
+
+# option actions we can skip over without running the real parser
+_SIMPLE_ACTIONS = ['store', 'store_const', 'store_true', 'store_false',
+    'append', 'append_const', 'count']
+
+
+class CacheMiss(Exception):
+    """
+    The cache is missing or stale, or cannot handle the given arguments
+    without running the actual commands.
+    """
+
+
+def _getSourceFile(module):
+    filename = getattr(sys.modules[module], '__file__', None)
+    if not filename:
+        return None
+    if filename[-4:] in ('.pyc', '.pyo'):
+        filename = filename[:-1]
+    return os.path.abspath(filename)
+
+
+def snapshot(c):
+    """
+    Create a serializable snapshot of the given command and all commands
+    below it.  This instantiates the whole tree.
+
+    @type  c: L{command.Command}
+
+    @rtype: dict
+    """
+    parser = c.parser
+    options = []
+    for option in parser._get_all_options():
+        options.append({
+            'short': option._short_opts,
+            'long': option._long_opts,
+            'action': option.action,
+            'nargs': option.takes_value() and (option.nargs or 1) or 0,
+            'help': option.help,
+            # these change what parse() does as a whole
+            'root': option in c._rootOptions,
+        })
+
+    children = {}
+    aliases = {}
+    for name, subCommand in c.getSubCommands().items():
+        children[name] = snapshot(subCommand)
+        for alias in subCommand.aliases or []:
+            aliases[alias] = name
+
+    return {
+        'name': c.name,
+        'aliases': c.aliases and list(c.aliases) or [],
+        'summary': c.summary,
+        'description': c.description,
+        'usage': parser.get_usage(),
+        'help': parser.format_help(),
+        'commands': parser.formatter.getCommands(),
+        'class': '%s.%s' % (c.__class__.__module__, c.__class__.__name__),
+        'options': options,
+        'children': children,
+        'aliasedChildren': aliases,
+        'allowAbbreviations': c.allowAbbreviations,
+    }
+
+
+def _getSources(node, sources):
+    module = node['class'].rsplit('.', 1)[0]
+    filename = _getSourceFile(module)
+    if filename:
+        sources[filename] = None
+    for child in node['children'].values():
+        _getSources(child, sources)
+
+
+class CommandCache(object):
+    """
+    I cache the metadata of a command tree in a file.
+
+    The cache is invalidated when any module implementing a command in
+    the tree, or this library, changes, or when the program name or
+    terminal width used for help output changes.
+
+    Note that with a cached result, handleOptions() is not called on the
+    commands that were walked through.
+
+    @ivar path:     the file to store the cache in
+    @type path:     str
+    @ivar rootPath: where the root command class lives,
+                    as 'package.module:Class'
+    @type rootPath: str
+    """
+
+    _tree = None
+
+    def __init__(self, path, rootPath, width=None):
+        self.path = os.path.expanduser(path)
+        self.rootPath = rootPath
+        self._width = width
+
+    def _getKey(self):
+        # everything except module changes that changes the output
+        return [VERSION, self.rootPath, self._width,
+            os.environ.get('COLUMNS'), os.path.basename(sys.argv[0])]
+
+    def write(self, c):
+        """
+        Snapshot the given root command and write it to the cache file.
+
+        @type  c: L{command.Command}
+        """
+        import json
+
+        tree = snapshot(c)
+        sources = {}
+        _getSources(tree, sources)
+        sources[_getSourceFile(command.__name__)] = None
+        for filename in sources.keys():
+            try:
+                st = os.stat(filename)
+            except OSError:
+                # no way of checking this source, so don't cache
+                return
+            sources[filename] = [st.st_mtime, st.st_size]
+
+        data = {
+            'key': self._getKey(),
+            'sources': sources,
+            'tree': tree,
+        }
+
+        # write atomically, so concurrent invocations never see
+        # a partial cache
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp = '%s.%d' % (self.path, os.getpid())
+        handle = open(tmp, 'w')
+        try:
+            json.dump(data, handle)
+        finally:
+            handle.close()
+        os.rename(tmp, self.path)
+
+        self._tree = tree
+
+    def load(self):
+        """
+        Load the cache file if it is still valid.
+
+        @rtype:   dict
+        @returns: the snapshot of the tree, or None if there is no valid
+                  cache.
+        """
+        import json
+
+        try:
+            handle = open(self.path)
+        except IOError:
+            return None
+        try:
+            try:
+                data = json.load(handle)
+            except ValueError:
+                return None
+        finally:
+            handle.close()
+
+        if data.get('key') != self._getKey():
+            return None
+
+        for filename, stat in data['sources'].items():
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return None
+            if [st.st_mtime, st.st_size] != stat:
+                return None
+
+        self._tree = data['tree']
+        return self._tree
+
+    def _skipOptions(self, node, args):
+        """
+        Skip over the options for the given node like its parser would.
+
+        @rtype:   tuple of (int, bool)
+        @returns: the index of the first argument,
+                  and whether help was asked for
+        """
+        options = {}
+        for option in node['options']:
+            for name in option['short'] + option['long']:
+                options[name] = option
+
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if arg == '--':
+                return i + 1, False
+
+            if arg.startswith('--'):
+                option = options.get(arg.split('=', 1)[0])
+                if not option or option['root']:
+                    # could be an abbreviation or an error
+                    raise CacheMiss()
+                if option['action'] == 'help':
+                    return i, True
+                if option['action'] not in _SIMPLE_ACTIONS:
+                    raise CacheMiss()
+                if option['nargs'] and '=' not in arg:
+                    i += option['nargs']
+                i += 1
+            elif arg.startswith('-') and arg != '-':
+                for j in range(1, len(arg)):
+                    option = options.get('-' + arg[j])
+                    if not option or option['root']:
+                        raise CacheMiss()
+                    if option['action'] == 'help':
+                        return i, True
+                    if option['action'] not in _SIMPLE_ACTIONS:
+                        raise CacheMiss()
+                    if option['nargs']:
+                        if j == len(arg) - 1:
+                            i += option['nargs']
+                        break
+                i += 1
+            else:
+                return i, False
+
+        if i > len(args):
+            # missing option argument; let the parser complain
+            raise CacheMiss()
+
+        return i, False
+
+    def route(self, argv):
+        """
+        Find out which commands the given arguments dispatch to, and what
+        they would do as far as the cache can tell.
+
+        @rtype:   tuple of (list of dict, str, list of str)
+        @returns: the snapshots of the commands on the path,
+                  what happens at the last one ('help', 'helpcommand',
+                  'nosubcommand' or 'unknown'), and the remaining
+                  arguments.
+        """
+        node = self._tree or self.load()
+        if node is None:
+            raise CacheMiss()
+
+        path = [node]
+        args = argv
+        while True:
+            i, helpAsked = self._skipOptions(node, args)
+            if helpAsked:
+                return path, 'help', args[i:]
+            args = args[i:]
+
+            if args and args[0] == 'help':
+                if len(args) == 1:
+                    return path, 'helpcommand', args
+                if not node['children']:
+                    raise CacheMiss()
+                args = [args[1], args[0]]
+
+            if not args or not node['children']:
+                # the command's do() needs to run
+                raise CacheMiss()
+
+            name = args[0]
+            name = node['aliasedChildren'].get(name, name)
+            if name not in node['children']:
+                if name and node['allowAbbreviations']:
+                    # let the command resolve the prefix
+                    raise CacheMiss()
+                if not name:
+                    return path, 'nosubcommand', args
+                return path, 'unknown', args
+
+            node = node['children'][name]
+            path.append(node)
+            args = args[1:]
+
+    def parse(self, argv, stdout=None, stderr=None):
+        """
+        Handle the given arguments from the cache, with the same output
+        and result as L{command.Command.parse}.
+
+        @raises CacheMiss: if the arguments need the actual commands.
+        """
+        stdout = stdout or sys.stdout
+        stderr = stderr or sys.stderr
+
+        path, action, args = self.route(argv)
+        node = path[-1]
+        if action == 'help':
+            stdout.write(_encode(node['help']))
+            return None
+        elif action == 'helpcommand':
+            stdout.write('\n')
+            stderr.write(_encode(node['help']))
+            return 0
+        elif action == 'nosubcommand':
+            stderr.write("Please specify a subcommand.\n")
+            return 1
+
+        stderr.write("Unknown command '%s'.\n" % args[0])
+        stderr.write(_encode(node['commands']))
+        return 1
+
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def _loadClass(path):
+    module, className = path.split(':')
+    __import__(module)
+    return getattr(sys.modules[module], className)
+
+
+def main(rootPath, cachePath, argv=None, stdout=None, stderr=None,
+        width=None):
+    """
+    Run the root command at the given path on the given arguments,
+    using and maintaining a cache of its metadata.
+
+    @param rootPath:  where the root command class lives,
+                      as 'package.module:Class'
+    @type  rootPath:  str
+    @param cachePath: the file to store the cache in
+    @type  cachePath: str
+    @param argv:      the arguments; defaults to sys.argv[1:]
+
+    @rtype: int
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    cache = CommandCache(cachePath, rootPath, width=width)
+    try:
+        return cache.parse(argv, stdout=stdout, stderr=stderr)
+    except CacheMiss:
+        pass
+
+    root = _loadClass(rootPath)(stdout=stdout, stderr=stderr, width=width)
+    if cache._tree is None:
+        # the cache is an optimization; never fail the invocation for it,
+        # for example because a referenced subcommand can not be imported
+        try:
+            cache.write(root)
+        except Exception, e:
+            root.debug('not caching the command tree: %r', e)
+
+    return root.parse(argv)
@@ -7,8 +7,113 @@
 Command class.
 """
 
+import cmd
 import optparse
+import os
 import sys
+import time
+import types
+
+
+# the levels of the logging module, so we don't need to import it
+DEBUG = 10
+INFO = 20
+WARNING = 30
+
+
+class Lazy(object):
+    """
+    I call a function only when I am formatted, so that arguments to
+    L{Command.debug} and friends that are expensive to compute, like
+    tracebacks, only get computed when they are actually logged.
+    """
+
+    def __init__(self, function, *args):
+        self._function = function
+        self._args = args
+
+    def __str__(self):
+        return str(self._function(*self._args))
+
+    def __repr__(self):
+        return repr(self._function(*self._args))
+
+
+class OutputBuffer(object):
+    """
+    I coalesce writes to one or more streams into fewer, bigger writes,
+    keeping the order of the writes across streams.
+
+    @ivar size:  the number of bytes to buffer before writing
+    @type size:  int
+    @ivar lines: whether to write at the end of each line
+    @type lines: bool
+    """
+
+    def __init__(self, size=8192, lines=False):
+        self.size = size
+        self.lines = lines
+        self._chunks = [] # list of (stream, list of data)
+        self._length = 0
+
+    def write(self, stream, data):
+        if self._chunks and self._chunks[-1][0] is stream:
+            self._chunks[-1][1].append(data)
+        else:
+            self._chunks.append((stream, [data, ]))
+        self._length += len(data)
+
+        if self._length >= self.size or (self.lines and '\n' in data):
+            self.flush()
+
+    def flush(self):
+        chunks = self._chunks
+        self._chunks = []
+        self._length = 0
+        for stream, data in chunks:
+            stream.write(''.join(data))
+            if hasattr(stream, 'flush'):
+                stream.flush()
+
+
+class BufferedWriter(object):
+    """
+    I am a write-file-like object that writes to a stream through
+    an L{OutputBuffer}.
+    """
+
+    softspace = 0
+
+    def __init__(self, buffer, stream):
+        self.buffer = buffer
+        self.stream = stream
+
+    def write(self, data):
+        # the buffer joins what is written, so don't mix unicode and str
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.buffer.write(self.stream, data)
+
+    def writelines(self, lines):
+        self.write(''.join(lines))
+
+    def flush(self):
+        self.buffer.flush()
+
+    def isatty(self):
+        return self.stream.isatty()
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def _getEncoding(self):
+        return getattr(self.stream, 'encoding', None)
+    encoding = property(_getEncoding)
+
+
+def _isIterator(o):
+    # deferreds and futures are not iterators; strings are not either
+    return hasattr(o, 'next') and hasattr(o, '__iter__')
 
 
 class CommandHelpFormatter(optparse.IndentedHelpFormatter):
@@ -21,20 +126,39 @@ class CommandHelpFormatter(optparse.IndentedHelpFormatter):
     _aliases = None
     _klass = None
 
+    # cached renderings; reset when commands, aliases or class change
+    _commandsText = None
+    _descriptions = None
+    generation = 0
+
+    def _changed(self):
+        self._commandsText = None
+        self._descriptions = None
+        self.generation += 1
+
     def addCommand(self, name, description):
         if self._commands is None:
             self._commands = {}
         self._commands[name] = description
+        self._changed()
 
     def addAlias(self, alias):
         if self._aliases is None:
             self._aliases = []
         self._aliases.append(alias)
+        self._changed()
 
     def setClass(self, klass):
         self._klass = klass
+        self._changed()
 
     def getCommands(self):
+        if self._commandsText is None:
+            self._commandsText = self._formatCommands()
+
+        return self._commandsText
+
+    def _formatCommands(self):
         ret = ""
 
         if self._commands:
@@ -46,8 +170,8 @@ class CommandHelpFormatter(optparse.IndentedHelpFormatter):
             for key in keys:
                 if len(key) > length:
                     length = len(key)
+            formatString = "  %-" + "%d" % length + "s  %s"
             for name in keys:
-                formatString = "  %-" + "%d" % length + "s  %s"
                 commandDesc.append(formatString % (name, self._commands[name]))
             ret += "\n" + "\n".join(commandDesc) + "\n"
 
@@ -57,6 +181,17 @@ class CommandHelpFormatter(optparse.IndentedHelpFormatter):
     ### override parent method
 
     def format_description(self, description, width=None):
+        key = (description, self.width)
+        if self._descriptions is None:
+            self._descriptions = {}
+        elif key in self._descriptions:
+            return self._descriptions[key]
+
+        ret = self._formatDescription(description)
+        self._descriptions[key] = ret
+        return ret
+
+    def _formatDescription(self, description):
         # textwrap doesn't allow for a way to preserve double newlines
         # to separate paragraphs, so we do it here.
         paragraphs = description.split('\n\n')
@@ -106,12 +241,46 @@ class CommandOptionParser(optparse.OptionParser):
     _stdout = sys.stdout
     _stderr = sys.stderr
 
+    _help = None
+    _helpKey = None
+
     def set_stdout(self, stdout):
         self._stdout = stdout
 
     def set_stderr(self, stderr):
         self._stderr = stderr
 
+    def set_default(self, dest, value):
+        optparse.OptionParser.set_default(self, dest, value)
+        self._helpKey = None
+
+    def set_defaults(self, **kwargs):
+        optparse.OptionParser.set_defaults(self, **kwargs)
+        self._helpKey = None
+
+    def _getHelpKey(self):
+        # everything that format_help() output depends on, cheap to check;
+        # options added directly to a group get counted too
+        count = len(self.option_list)
+        for group in self.option_groups:
+            count += len(group.option_list)
+        return (count, len(self.option_groups), self.usage, self.description,
+            self.epilog, self.get_prog_name(), self.formatter.width,
+            getattr(self.formatter, 'generation', None))
+
+    def format_help(self, formatter=None):
+        # rendering help is expensive and commands in interactive shells
+        # get asked for it a lot, so cache it
+        if formatter is not None:
+            return optparse.OptionParser.format_help(self, formatter)
+
+        key = self._getHelpKey()
+        if self._helpKey != key:
+            self._help = optparse.OptionParser.format_help(self)
+            self._helpKey = key
+
+        return self._help
+
     def parse_args(self, args=None, values=None):
         self.help_printed = False
         self.usage_printed = False
@@ -155,6 +324,149 @@ class CommandOptionParser(optparse.OptionParser):
         self.print_usage(self._stderr)
         raise CommandError(msg)
 
+class CommandIndex(object):
+    """
+    I map the names and aliases of subcommands, and optionally their
+    unambiguous prefixes, to the name of the subcommand with a single
+    lookup.
+    """
+
+    def __init__(self):
+        self._names = {} # name or alias -> name
+        self._prefixes = None # prefix -> name or tuple of names
+        self._sorted = None # sorted names and aliases, for complete()
+
+    def add(self, name, aliases=None):
+        """
+        Add a subcommand with the given name and aliases.
+
+        @raises AttributeError: if a name or alias is already used by
+                                another subcommand
+        """
+        for key in [name, ] + list(aliases or []):
+            other = self._names.get(key, name)
+            if other != name:
+                raise AttributeError, \
+                    "%r is used by both subcommands %r and %r" % (
+                        key, other, name)
+            self._names[key] = name
+
+        self._prefixes = None
+        self._sorted = None
+
+    def lookup(self, key, abbreviations=False):
+        """
+        Look up the subcommand with the given name, alias, or, if
+        abbreviations is True, unambiguous prefix.
+
+        @rtype:   str or tuple of str or None
+        @returns: the name of the subcommand; a sorted tuple of the
+                  candidate names if the prefix is ambiguous;
+                  or None if nothing matches.
+        """
+        name = self._names.get(key)
+        if name is not None or not abbreviations:
+            return name
+
+        if self._prefixes is None:
+            self._prefixes = self._getPrefixes()
+
+        return self._prefixes.get(key)
+
+    def complete(self, prefix):
+        """
+        Return the names and aliases starting with the given prefix.
+
+        @rtype: list of str
+        """
+        import bisect
+
+        if self._sorted is None:
+            self._sorted = sorted(self._names.keys())
+
+        keys = self._sorted
+        i = bisect.bisect_left(keys, prefix)
+        j = i
+        while j < len(keys) and keys[j].startswith(prefix):
+            j += 1
+        return keys[i:j]
+
+    def _getPrefixes(self):
+        candidates = {}
+        for key, name in self._names.items():
+            for i in range(1, len(key)):
+                candidates.setdefault(key[:i], set()).add(name)
+
+        prefixes = {}
+        for prefix, names in candidates.items():
+            if len(names) == 1:
+                prefixes[prefix] = names.pop()
+            else:
+                prefixes[prefix] = tuple(sorted(names))
+
+        return prefixes
+
+
+def getCommandName(klass):
+    """
+    Return the name a command class will be registered under,
+    without instantiating it.
+
+    @rtype: str
+    """
+    return klass.name or klass.__name__.lower()
+
+
+class CommandReference(object):
+    """
+    I stand in for a L{Command} subclass in subCommandClasses, so that
+    the module implementing it only gets imported when the command is
+    dispatched to or its help is asked for.
+
+    The name, aliases and summary are declared statically, so the parent
+    command can list and look up the subcommand without importing it.
+
+    @ivar path:    where the class lives, as 'package.module:Class'
+    @type path:    str
+    @ivar name:    the name of the command; must match the name of
+                   the class; defaults to the lowercase class name
+    @type name:    str
+    """
+
+    def __init__(self, path, name=None, aliases=None, summary=None,
+            description=None):
+        self.path = path
+        self.module, self.className = path.split(':')
+        self.name = name or self.className.lower()
+        self.aliases = aliases
+        self.summary = summary
+        self.description = description
+        self._klass = None
+
+    def __repr__(self):
+        return '<CommandReference %s for %s>' % (self.name, self.path)
+
+    def load(self):
+        """
+        Import the module and return the class referenced.
+
+        @rtype: C{class}
+        """
+        if self._klass is None:
+            __import__(self.module)
+            klass = getattr(sys.modules[self.module], self.className)
+            if getCommandName(klass) != self.name:
+                raise AttributeError, \
+                    "%s is referenced as %r but is named %r" % (
+                        self.path, self.name, getCommandName(klass))
+            self._klass = klass
+
+        return self._klass
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
 class Command(object):
     """
     I am a class that handles a command for a program.
@@ -173,7 +485,45 @@ class Command(object):
     @cvar description: longer paragraph explaining the command
     @cvar subCommands: dict of name -> commands below this command
     @type subCommands: dict of str  -> L{Command}
-    @cvar parser:      the option parser used for parsing
+    @cvar subCommandClasses: list of classes of commands below this command;
+                       L{CommandReference} can be used to only import
+                       a subcommand's module when it is used
+    @type subCommandClasses: list of C{class} or L{CommandReference}
+    @cvar lazySubCommands: whether to only instantiate subcommands when
+                       they are dispatched to, instead of at construction.
+                       In lazy mode, subCommands and aliasedSubCommands
+                       only contain the subcommands created so far;
+                       use getSubCommand() or getSubCommands() instead.
+    @type lazySubCommands: bool
+    @cvar allowAbbreviations: whether subcommands can be invoked by an
+                       unambiguous prefix of their name or one of
+                       their aliases
+    @type allowAbbreviations: bool
+    @cvar logger:      a L{logging.Logger} that debug(), info() and
+                       warning() log to by default
+    @cvar allowBatch:  whether this command, when used as the root,
+                       has --batch and --jobs options to run many
+                       command lines, optionally in parallel
+    @type allowBatch:  bool
+    @cvar allowTimings: whether this command, when used as the root,
+                       has --timings and --timings-json options to show
+                       how long each phase of parsing took
+    @type allowTimings: bool
+    @cvar allowJSON:   whether this command, when used as the root,
+                       has a --json option to output the records passed
+                       to emit(), the exit status and errors as JSON lines
+    @type allowJSON:   bool
+    @cvar bufferSize:  if set on the root command, output of all commands
+                       is buffered while parsing, and written when this
+                       many bytes are buffered, on flush(), on
+                       CommandExited, and when parsing is done
+    @type bufferSize:  int
+    @cvar bufferLines: whether buffered output is also written at the
+                       end of each line
+    @type bufferLines: bool
+    @ivar options:     the options parsed by the last parse() call
+    @ivar parser:      the option parser used for parsing;
+                       created on first access
     @type parser:      L{optparse.OptionParser}
     """
     name = None
@@ -185,7 +535,24 @@ class Command(object):
     subCommands = None
     subCommandClasses = None
     aliasedSubCommands = None
-    parser = None
+    lazySubCommands = False
+    allowAbbreviations = False
+    logger = None
+    allowBatch = False
+    allowTimings = False
+    allowJSON = False
+    bufferSize = None
+    bufferLines = False
+    options = None
+
+    _parser = None # created on first use; see _getParser()
+    _streamGeneration = 0 # bumped when a stream is set on any command
+    _timingHooks = () # set on the root command; see addTimingHook()
+    _outputBuffer = None # set on the root command while parsing
+    _cmdClass = None # created by commandToCmdClass()
+    _structured = None # set on the root command once --json is parsed
+    _rootOptions = () # the options added by _addRootOptions()
+    _inBatch = False # set on the root command while --batch runs
 
     def __init__(self, parentCommand=None, stdout=None,
         stderr=None, width=None):
@@ -196,36 +563,53 @@ class Command(object):
         """
         if not self.name:
             self.name = self.__class__.__name__.lower()
-        self._stdout = stdout
-        self._stderr = stderr
+        # set directly; nothing can have cached a lookup through us yet
+        self._streams = {'stdout': stdout, 'stderr': stderr}
+        self._streamCache = {}
+        self._width = width
         self.parentCommand = parentCommand
 
-        # create subcommands if we have them
+        # map names and aliases of subcommands to their classes;
+        # subcommands themselves get created by getSubCommand()
         self.subCommands = {}
         self.aliasedSubCommands = {}
+        self._subCommandClasses = {}
+        self._index = CommandIndex()
         if self.subCommandClasses:
             for C in self.subCommandClasses:
-                c = C(self, stdout=stdout, stderr=stderr, width=width)
-                self.subCommands[c.name] = c
-                if c.aliases:
-                    for alias in c.aliases:
-                        self.aliasedSubCommands[alias] = c
+                name = getCommandName(C)
+                if name in self._subCommandClasses:
+                    raise AttributeError, \
+                        "%r has two subcommands named %r" % (self, name)
+                self._subCommandClasses[name] = C
+                self._index.add(name, C.aliases)
 
+            if not self.lazySubCommands:
+                for C in self.subCommandClasses:
+                    self.getSubCommand(getCommandName(C))
+
+        if self._subCommandClasses and not self.description:
+            if self.summary:
+                self.description = self.summary
+            else:
+                raise AttributeError, \
+                    "%r needs a summary or description " \
+                    "for help formatting" % self
+
+    def _createParser(self):
+        """
+        Create the formatter, usage and option parser for this command,
+        and let subclasses add options.
+        """
         # create our formatter and add subcommands if we have them
-        formatter = CommandHelpFormatter(width=width)
+        formatter = CommandHelpFormatter(width=self._width)
         formatter.setClass(self.__class__)
-        if self.subCommands:
-            if not self.description:
-                if self.summary:
-                    self.description = self.summary
-                else:
-                    raise AttributeError, \
-                        "%r needs a summary or description " \
-                        "for help formatting" % self
-
-            for name, command in self.subCommands.items():
-                formatter.addCommand(name, command.summary or
-                    command.description or '')
+        if self._subCommandClasses:
+            # summaries come from the classes, so listing subcommands
+            # does not need them to be instantiated
+            for name, C in self._subCommandClasses.items():
+                formatter.addCommand(name, C.summary or
+                    C.description or '')
 
         if self.aliases:
             for alias in self.aliases:
@@ -235,7 +619,7 @@ class Command(object):
         usage = self.usage or ''
         if not usage:
             # if no usage, but subcommands, then default to showing that
-            if self.subCommands:
+            if self._subCommandClasses:
                 usage = "%command"
 
         # the main program name shouldn't get prepended, because %prog
@@ -245,7 +629,7 @@ class Command(object):
 
         usages = [usage, ]
         if usage.find("%command") > -1:
-            if self.subCommands:
+            if self._subCommandClasses:
                 usage = usage.split("%command")[0] + '[command]'
                 usages = [usage, ]
             else:
@@ -272,16 +656,82 @@ class Command(object):
         description = self.description or self.summary
         if description:
             description = description.strip()
-        self.parser = CommandOptionParser(
+        self._parser = CommandOptionParser(
             usage=usage, description=description,
             formatter=formatter)
-        self.parser.set_stdout(self.stdout)
-        self.parser.set_stderr(self.stderr)
-        self.parser.disable_interspersed_args()
+        self._parser.set_stdout(self.stdout)
+        self._parser.set_stderr(self.stderr)
+        self._parser.disable_interspersed_args()
+
+        if not self.parentCommand:
+            count = len(self._parser.option_list)
+            self._addRootOptions()
+            self._rootOptions = self._parser.option_list[count:]
 
         # allow subclasses to add options
         self.addOptions()
 
+    def _addRootOptions(self):
+        """
+        Add the options that only make sense on the root command.
+        """
+        if self.allowTimings:
+            self._addTimingOptions()
+        if self.allowJSON:
+            self._parser.add_option('--json',
+                action="store_true", dest="json", default=False,
+                help="output records, the exit status and errors "
+                    "as JSON lines")
+        if self.allowBatch:
+            self._parser.add_option('--batch',
+                action="store", dest="batch", metavar="FILE",
+                help="run each command line in FILE, or on stdin if FILE "
+                    "is -, instead of the given arguments")
+            self._parser.add_option('--jobs',
+                action="store", dest="jobs", type="int", default=1,
+                metavar="N",
+                help="run the command lines of --batch in N processes "
+                    "(default %default)")
+
+    def _addTimingOptions(self):
+        self._parser.add_option('--timings',
+            action="store_const", dest="timings", const="table",
+            help="show how long each phase of parsing took on stderr")
+        self._parser.add_option('--timings-json',
+            action="store_const", dest="timings", const="json",
+            help="show how long each phase of parsing took on stderr, "
+                "as JSON")
+
+    def _handleRootOptions(self, args):
+        """
+        Act on the options that only make sense on the root command.
+
+        @rtype:   int or None
+        @returns: an exit code if the invocation was handled,
+                  or None to continue parsing.
+        """
+        if self.allowBatch and self.options.batch:
+            if args:
+                self.stderr.write("--batch does not take arguments.\n")
+                return 1
+            if self._inBatch:
+                self.stderr.write("--batch can not be used in a batch.\n")
+                return 1
+
+            return self._runBatchFile(self.options.batch)
+
+    def _getParser(self):
+        if self._parser is None:
+            timer = self._startTiming()
+            self._createParser()
+            self._stopTiming('parser', timer)
+        return self._parser
+
+    def _setParser(self, parser):
+        self._parser = parser
+
+    parser = property(_getParser, _setParser)
+
     def addOptions(self):
         """
         Override me to add options to the parser.
@@ -292,7 +742,12 @@ class Command(object):
         """
         Override me to implement the functionality of the command.
 
-        @rtype:   int
+        Instead of writing its output, do() can also return an iterator,
+        for example by being a generator, of items to write to stdout
+        as they are produced; see outputItem().  Raise L{CommandExited}
+        from the iterator to set the exit code.
+
+        @rtype:   int or iterator
         @returns: an exit code, or None if no actual action was taken.
         """
         raise NotImplementedError('Implement %s.do()' % self.__class__)
@@ -309,30 +764,80 @@ class Command(object):
         @rtype:   int
         @returns: an exit code, or None if no actual action was taken.
         """
+        if self.parentCommand:
+            return self._parse(argv)
+
+        if self.bufferSize:
+            return self._parseBuffered(argv)
+
+        return self._parseTimed(argv)
+
+    def _parse(self, argv):
         # note: no arguments should be passed as an empty list, not a list
         # with an empty str as ''.split(' ') returns
-        self.debug('calling %r.parse_args(%r)' % (self, argv))
-        self.options, args = self.parser.parse_args(argv)
-        self.debug('called %r.parse_args' % self)
+        self.debug('calling %r.parse_args(%r)', self, argv)
+        # our streams may have been redirected since the parser was created
+        # with --json, help becomes a record; for the root command we only
+        # know whether it was given after parsing, so always capture it
+        root = self.getRootCommand()
+        capture = None
+        if root.allowJSON:
+            import StringIO
+            capture = StringIO.StringIO()
+            self.parser.set_stdout(capture)
+        else:
+            self.parser.set_stdout(self.stdout)
+        self.parser.set_stderr(self.stderr)
+        timer = self._startTiming()
+        try:
+            self.options, args = self.parser.parse_args(argv)
+        finally:
+            # do() can print help through the parser too
+            if capture is not None:
+                self.parser.set_stdout(self.stdout)
+        self._stopTiming('parse_args', timer)
+        self.debug('called %r.parse_args', self)
+
+        if root is self and self.allowJSON and self._structured is None:
+            self._structured = bool(self.options.json)
+        if capture is not None and capture.getvalue():
+            if self.isStructured():
+                self.emit({'output': capture.getvalue()})
+            else:
+                self.stdout.write(capture.getvalue())
 
         # if we were asked to print help or usage, we are done
         if self.parser.usage_printed or self.parser.help_printed:
             return None
 
+        if not self.parentCommand:
+            ret = self._handleRootOptions(args)
+            if ret is not None:
+                return ret
+
         # FIXME: make handleOptions not take options, since we store it
         # in self.options now
-        self.debug('calling %r.handleOptions(%r)' % (self, self.options))
+        self.debug('calling %r.handleOptions(%r)', self, self.options)
+        timer = self._startTiming()
         ret = self.handleOptions(self.options)
-        self.debug('called %r.handleOptions, returned %r' % (self, ret))
+        self._stopTiming('handleOptions', timer)
+        self.debug('called %r.handleOptions, returned %r', self, ret)
         if ret:
             return ret
 
         # handle pleas for help
         if args and args[0] == 'help':
-            self.debug('Asked for help, args %r' % args)
+            self.debug('Asked for help, args %r', args)
 
             # give help on current command if only 'help' is passed
             if len(args) == 1:
+                if self.isStructured():
+                    import StringIO
+                    capture = StringIO.StringIO()
+                    self.outputHelp(file=capture)
+                    self.emit({'output': capture.getvalue()})
+                    return 0
+
                 # start on a newline for the case where we're in the
                 # interpreter
                 self.stdout.write('\n')
@@ -341,7 +846,7 @@ class Command(object):
 
             # complain if we were asked for help on a subcommand, but we don't
             # have any
-            if not self.subCommands:
+            if not self._subCommandClasses:
                 self.stderr.write('No subcommands defined.\n')
                 self.parser.print_usage(file=self.stderr)
                 self.stderr.write(
@@ -356,29 +861,51 @@ class Command(object):
         # if we don't have args or don't have subcommands,
         # defer to our do() method
         # allows implementing a do() for commands that also have subcommands
-        if not args or not self.subCommands:
-            self.debug('no args or no subcommands, calling %r.do(%r)' % (
-                self, args))
+        if not args or not self._subCommandClasses:
+            self.debug('no args or no subcommands, calling %r.do(%r)',
+                self, args)
+            timer = self._startTiming()
             try:
                 ret = self.do(args)
+                if _isIterator(ret):
+                    self.debug('done ok, streaming output of %r', ret)
+                    ret = self._doStream(ret)
                 self.debug('done ok, returned %r', ret)
             except CommandOk, e:
                 self.debug('done with exception, raised %r', e)
                 ret = e.status
-                if e.output is not None:
+                if e.output is None:
+                    pass
+                elif self.isStructured():
+                    self.emit({'output': e.output})
+                else:
                     self.stdout.write(e.output + '\n')
+                self.flush()
             except CommandExited, e:
                 self.debug('done with exception, raised %r', e)
                 ret = e.status
-                if e.output is not None:
+                if e.output is None:
+                    pass
+                elif self.isStructured():
+                    self.emit({'error': e.output, 'status': e.status})
+                else:
                     self.stderr.write(e.output + '\n')
+                self.flush()
             except NotImplementedError:
                 self.debug('done with NotImplementedError')
                 self.parser.print_usage(file=self.stderr)
                 self.stderr.write(
                     "Use --help to get a list of commands.\n")
                 ret = 1
+            self._stopTiming('do', timer)
 
+            # time deferreds and futures until they are done
+            if timer is not None:
+                if hasattr(ret, 'addBoth'):
+                    ret.addBoth(self._stopTimingResult, 'doLater', timer)
+                elif hasattr(ret, 'add_done_callback'):
+                    ret.add_done_callback(
+                        lambda f: self._stopTiming('doLater', timer))
 
             # if everything's fine, we return 0
             if not ret:
@@ -397,12 +924,16 @@ class Command(object):
 
         # FIXME: check users and enable this
         # assert type(command) is unicode
-        if command in self.subCommands.keys():
-            return self.subCommands[command].parse(args[1:])
+        timer = self._startTiming()
+        name = self._index.lookup(command, self.allowAbbreviations)
+        self._stopTiming('lookup', timer)
+        if isinstance(name, tuple):
+            self.stderr.write("Ambiguous command '%s', could be %s.\n" % (
+                command.encode('utf-8'), ", ".join(name)))
+            return 1
 
-        if self.aliasedSubCommands:
-            if command in self.aliasedSubCommands.keys():
-                return self.aliasedSubCommands[command].parse(args[1:])
+        if name is not None:
+            return self.getSubCommand(name).parse(args[1:])
 
         if not command:
             self.stderr.write("Please specify a subcommand.\n")
@@ -412,6 +943,447 @@ class Command(object):
             self.parser.print_commands(file=self.stderr)
         return 1
 
+    def _doStream(self, iterator):
+        # write items as they are produced, so output is never held
+        # in memory as a whole
+        while True:
+            try:
+                item = iterator.next()
+            except StopIteration, e:
+                # a generator's return value, on Python 3
+                return getattr(e, 'value', None)
+            self.outputItem(item)
+
+    def outputItem(self, item):
+        """
+        Write an item produced by the iterator returned from do().
+
+        Override me to format items differently; by default, dicts are
+        passed to emit(), and other items are written to stdout as a line.
+
+        @type item: dict or str or unicode or object
+        """
+        if isinstance(item, dict):
+            self.emit(item)
+            return
+
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        elif not isinstance(item, str):
+            item = str(item)
+        if not item.endswith('\n'):
+            item += '\n'
+        self.stdout.write(item)
+
+    def getCompletions(self, args, text):
+        """
+        Return the completions of text as the next argument, after the
+        given arguments to this command; subcommand names and aliases, or
+        option strings if text starts with -.
+
+        Only the subcommands named in args get created.
+
+        @type  args: list of str
+        @type  text: str
+
+        @rtype: list of str
+        """
+        c = self
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg.startswith('-'):
+                # skip the value of an option that takes one
+                option = c.parser.get_option(arg)
+                if option and option.takes_value() and args:
+                    args.pop(0)
+                continue
+
+            # arguments to a command without subcommands
+            if not c._subCommandClasses:
+                continue
+
+            name = c._index.lookup(arg, c.allowAbbreviations)
+            if not isinstance(name, str):
+                return []
+            c = c.getSubCommand(name)
+
+        if text.startswith('-'):
+            strings = c.parser._short_opt.keys() + c.parser._long_opt.keys()
+            return sorted([o for o in strings if o.startswith(text)])
+
+        return c._index.complete(text)
+
+    def isStructured(self):
+        """
+        Return whether output is JSON lines, because the root command
+        allows it and --json was given.
+
+        @rtype: bool
+        """
+        return bool(self.getRootCommand()._structured)
+
+    def emit(self, record):
+        """
+        Output a record; as a JSON line if isStructured(),
+        and formatted by formatRecord() otherwise.
+
+        @type record: dict of str -> object that can be serialized to JSON
+        """
+        if self.isStructured():
+            import json
+            self.stdout.write(json.dumps(record) + '\n')
+        else:
+            self.stdout.write(self.formatRecord(record))
+
+    def formatRecord(self, record):
+        """
+        Override me to format records for humans.
+        By default, each record is a line of key=value pairs.
+
+        @type  record: dict of str -> object
+        @rtype: str
+        """
+        pairs = []
+        for key in sorted(record.keys()):
+            value = record[key]
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            pairs.append('%s=%s' % (key, value))
+        return ' '.join(pairs) + '\n'
+
+    def getSubCommand(self, name):
+        """
+        Return the subcommand with the given name or alias, creating it
+        if it was not created yet.
+
+        @type  name: str
+
+        @rtype:   L{Command} or None
+        @returns: the subcommand, or None if there is no such subcommand.
+        """
+        name = self._index.lookup(name)
+        if name is None:
+            return None
+
+        c = self.subCommands.get(name)
+        if c is not None:
+            return c
+
+        C = self._subCommandClasses.get(name)
+        if C is None:
+            return None
+
+        # stdout and stderr get delegated to us, so don't pass them
+        timer = self._startTiming()
+        c = C(self, width=self._width)
+        c._stopTiming('construct', timer)
+        self.subCommands[name] = c
+        if C.aliases:
+            for alias in C.aliases:
+                self.aliasedSubCommands[alias] = c
+
+        return c
+
+    def getSubCommands(self):
+        """
+        Return all subcommands, creating the ones not created yet.
+
+        @rtype: dict of str -> L{Command}
+        """
+        for name in self._subCommandClasses.keys():
+            self.getSubCommand(name)
+
+        return self.subCommands
+
+    def addTimingHook(self, hook):
+        """
+        Add a hook to be called with the timing of each phase of parsing,
+        on this command and the commands below it.
+
+        The phases are 'construct' and 'parser', when a command and its
+        parser get created; 'parse_args', 'handleOptions', 'lookup' of
+        the subcommand, and 'do'; and 'doLater' until the deferred or
+        future returned from do() is done.
+
+        @param hook: called with the command, the phase, and the wall
+                     clock and CPU time it took, in seconds
+        @type  hook: callable
+        """
+        root = self.getRootCommand()
+        root._timingHooks = root._timingHooks + (hook, )
+
+    def removeTimingHook(self, hook):
+        root = self.getRootCommand()
+        hooks = list(root._timingHooks)
+        hooks.remove(hook)
+        root._timingHooks = tuple(hooks)
+
+    def _startTiming(self):
+        # returns None when nobody listens, so timing is nearly free then
+        if not self.getRootCommand()._timingHooks:
+            return None
+
+        times = os.times()
+        return time.time(), times[0] + times[1]
+
+    def _stopTiming(self, phase, timer):
+        if timer is None:
+            return
+
+        times = os.times()
+        wall = time.time() - timer[0]
+        cpu = times[0] + times[1] - timer[1]
+        for hook in self.getRootCommand()._timingHooks:
+            hook(self, phase, wall, cpu)
+
+    def _stopTimingResult(self, result, phase, timer):
+        self._stopTiming(phase, timer)
+        return result
+
+    def _callWhenDone(self, result, function):
+        # call function with the result of parse once it is done,
+        # which for deferreds is when they fire, and for futures is when
+        # they are done; with their exception if they have one
+        if hasattr(result, 'addBoth'):
+            result.addBoth(function)
+            return result
+
+        if hasattr(result, 'add_done_callback'):
+
+            def done(future):
+                if future.cancelled():
+                    function(None)
+                elif future.exception() is not None:
+                    function(future.exception())
+                else:
+                    function(future.result())
+
+            result.add_done_callback(done)
+            return result
+
+        return function(result)
+
+    def _parseStructured(self, argv):
+        if not self.allowJSON:
+            return self._parse(argv)
+
+        # the outer parse decides on the mode, for example for --batch;
+        # _parse() sets it once our options are parsed
+        outer = self._structured is None
+
+        def exited(e):
+            # like the handlers of do() in _parse()
+            if e.output is None:
+                pass
+            elif isinstance(e, CommandOk):
+                self.emit({'output': e.output})
+            else:
+                self.emit({'error': e.output, 'status': e.status})
+            return e.status
+
+        def done(result):
+            try:
+                if not self.isStructured():
+                    return result
+
+                # deferreds can fail, and futures raise, with CommandExited
+                if hasattr(result, 'check') and result.check(CommandExited):
+                    result = exited(result.value)
+                elif isinstance(result, CommandExited):
+                    result = exited(result)
+
+                if outer and (result is None or isinstance(result, int)):
+                    self.emit({'exit': result or 0})
+                return result
+            finally:
+                if outer:
+                    self._structured = None
+
+        try:
+            ret = self._parse(argv)
+        except CommandExited, e:
+            if not self.isStructured():
+                if outer:
+                    self._structured = None
+                raise
+            ret = e
+        except:
+            if outer:
+                self._structured = None
+            raise
+
+        return self._callWhenDone(ret, done)
+
+    def _parseTimed(self, argv):
+        if not self.allowTimings:
+            return self._parseStructured(argv)
+
+        # we don't know yet if --timings was given, so always collect
+        timings = []
+
+        def hook(c, phase, wall, cpu):
+            timings.append((c.getFullName(), phase, wall, cpu))
+
+        self.addTimingHook(hook)
+        try:
+            ret = self._parseStructured(argv)
+        except:
+            self.removeTimingHook(hook)
+            raise
+
+        def output(result):
+            self.removeTimingHook(hook)
+            if self.options and self.options.timings:
+                self._outputTimings(timings, self.options.timings)
+            return result
+
+        return self._callWhenDone(ret, output)
+
+    def _parseBuffered(self, argv):
+        # we can be parsing already, for example for --batch
+        previous = self._outputBuffer
+        stdout = self._stdout
+        stderr = self._stderr
+        buffer = OutputBuffer(self.bufferSize, self.bufferLines)
+        self._outputBuffer = buffer
+        self._stdout = BufferedWriter(buffer, self.stdout)
+        self._stderr = BufferedWriter(buffer, self.stderr)
+
+        def done(result):
+            try:
+                buffer.flush()
+            finally:
+                self._outputBuffer = previous
+                self._stdout = stdout
+                self._stderr = stderr
+            return result
+
+        try:
+            ret = self._parseTimed(argv)
+        except:
+            done(None)
+            raise
+
+        return self._callWhenDone(ret, done)
+
+    def flush(self):
+        """
+        Flush the output buffered by the root command, if any.
+        """
+        buffer = self.getRootCommand()._outputBuffer
+        if buffer:
+            buffer.flush()
+
+    def _outputTimings(self, timings, format):
+        if format == 'json':
+            import json
+            self.stderr.write(json.dumps([{
+                'command': name,
+                'phase': phase,
+                'wall': wall,
+                'cpu': cpu,
+            } for name, phase, wall, cpu in timings]) + '\n')
+            return
+
+        length = max([len(t[0]) for t in timings] + [len('command')])
+        formatString = "  %-" + "%d" % length + "s  %-13s  %10s  %10s\n"
+        self.stderr.write("Timings:\n")
+        self.stderr.write(formatString % (
+            'command', 'phase', 'wall (ms)', 'cpu (ms)'))
+        for name, phase, wall, cpu in timings:
+            self.stderr.write(formatString % (name, phase,
+                '%.3f' % (wall * 1000), '%.3f' % (cpu * 1000)))
+
+    def reset(self):
+        """
+        Reset the state left behind by a previous parse() on this command
+        and the subcommands created so far, so that the tree can be used
+        for another invocation.
+
+        Override me, and chain up, to reset state of your own.
+        """
+        self.options = None
+        if self._parser is not None:
+            self._parser.help_printed = False
+            self._parser.usage_printed = False
+        for c in self.subCommands.values():
+            c.reset()
+
+    def parseBatch(self, lines):
+        """
+        Parse and act on each of the given command lines in turn,
+        reusing this command and the subcommands it created.
+
+        @param lines: command lines, split like a shell would;
+                      empty lines and comments are skipped
+        @type  lines: iterable of str
+
+        @rtype:   list of (str, int)
+        @returns: each command line that was run, with its exit code
+        """
+        import shlex
+
+        rets = []
+        for line in lines:
+            argv = shlex.split(line, comments=True)
+            if not argv:
+                continue
+
+            self.reset()
+            try:
+                ret = self.parse(argv)
+            except CommandExited, e:
+                # for example, an option error; go on with the next line
+                self.debug('%r raised %r', line, e)
+                ret = e.status
+                if e.output is not None:
+                    if isinstance(e, CommandOk):
+                        self.stdout.write(e.output + '\n')
+                    else:
+                        self.stderr.write(e.output + '\n')
+            rets.append((line.strip(), ret or 0))
+
+        self.reset()
+        return rets
+
+    def _runBatchFile(self, path):
+        if path == '-':
+            handle = sys.stdin
+        else:
+            try:
+                handle = open(path)
+            except IOError, e:
+                self.stderr.write("Could not open %s: %s.\n" % (
+                    path, e.strerror))
+                return 1
+
+        # parsing the command lines replaces our options
+        options = self.options
+        self._inBatch = True
+        try:
+            if self.options.jobs > 1:
+                import pool
+                rets = pool.BatchPool(self, self.options.jobs).run(handle,
+                    stdout=self.stdout, stderr=self.stderr)
+            else:
+                rets = self.parseBatch(handle)
+        finally:
+            self.options = options
+            self._inBatch = False
+            if handle is not sys.stdin:
+                handle.close()
+
+        # report failures; the batch fails with the first failure
+        status = 0
+        for line, ret in rets:
+            if ret:
+                self.stderr.write("'%s' exited with %d.\n" % (line, ret))
+                if not status:
+                    status = ret
+
+        return status
+
     def handleOptions(self, options):
         """
         Handle the parsed options.
@@ -448,24 +1420,45 @@ class Command(object):
             c = c.parentCommand
         return c
 
+    def logEnabled(self, level):
+        """
+        Return whether messages of the given level would be logged
+        to self.logger.
+
+        @param level: one of L{DEBUG}, L{INFO} or L{WARNING}
+        @type  level: int
+
+        @rtype: bool
+        """
+        return self.logger is not None and self.logger.isEnabledFor(level)
+
     def warning(self, format, *args):
         """
         Override me to handle warning output from this class.
+        By default, logs to self.logger if set.
         """
-        pass
+        if self.logEnabled(WARNING):
+            self.logger.warning(format, *args)
 
     def info(self, format, *args):
         """
         Override me to handle info output from this class.
+        By default, logs to self.logger if set.
         """
-        pass
-
+        if self.logEnabled(INFO):
+            self.logger.info(format, *args)
 
     def debug(self, format, *args):
         """
         Override me to handle debug output from this class.
+        By default, logs to self.logger if set.
+
+        Pass arguments separately instead of formatting them in, so that
+        no formatting happens when nothing gets logged; wrap arguments
+        that are expensive to compute in L{Lazy}.
         """
-        pass
+        if self.logEnabled(DEBUG):
+            self.logger.debug(format, *args)
 
     def getFullName(self):
         names = []
@@ -477,17 +1470,28 @@ class Command(object):
         return " ".join(names)
 
     def _getStd(self, what):
-
-        ret = getattr(self, '_' + what, None)
-        if ret:
-            return ret
-
-        # if I am the root command, default
-        if not self.parentCommand:
-            return getattr(sys, what)
-
-        # otherwise delegate to my parent
-        return getattr(self.parentCommand, what)
+        # cache which stream we resolve to, until any command in any tree
+        # gets a stream set
+        cached = self._streamCache.get(what)
+        if cached is None or cached[0] != Command._streamGeneration:
+            # walk the tree up to the first command that has it set
+            stream = None
+            c = self
+            while c:
+                stream = c._streams.get(what)
+                if stream:
+                    break
+                c = c.parentCommand
+
+            cached = (Command._streamGeneration, stream)
+            self._streamCache[what] = cached
+
+        # if no command has it set, default to sys, which can change
+        return cached[1] or getattr(sys, what)
+
+    def _setStd(self, what, stream):
+        self._streams[what] = stream
+        Command._streamGeneration += 1
 
     def _getStdOut(self):
         return self._getStd('stdout')
@@ -498,6 +1502,24 @@ class Command(object):
     stdout = property(_getStdOut)
     stderr = property(_getStdErr)
 
+    # the streams set on this command itself, if any;
+    # setting them redirects the output of this command and its children
+
+    def _getOwnStdOut(self):
+        return self._streams['stdout']
+
+    def _setOwnStdOut(self, stream):
+        self._setStd('stdout', stream)
+
+    def _getOwnStdErr(self):
+        return self._streams['stderr']
+
+    def _setOwnStdErr(self, stream):
+        self._setStd('stderr', stream)
+
+    _stdout = property(_getOwnStdOut, _setOwnStdOut)
+    _stderr = property(_getOwnStdErr, _setOwnStdErr)
+
 
 class CommandExited(Exception):
 
@@ -519,6 +1541,71 @@ class CommandError(CommandExited):
         CommandExited.__init__(self, 3, output)
 
 
+class _CommandWrappingCmd(cmd.Cmd):
+    """
+    I am the base class of the L{cmd.Cmd} classes created by
+    L{commandToCmdClass}, with a Ctrl-D handler and a cd command to
+    enter the scope of a subcommand.
+    """
+    prompt = '(command) '
+    exited = False
+    command = None # the Command instance whose subcommands we run
+
+    def __repr__(self):
+        return "<_CommandWrappingCmd for Command %r>" % self.command
+
+    def do_EOF(self, args):
+        self.stdout.write('\n')
+        self.exited = True
+        sys.exit(0)
+
+    def do_exit(self, args):
+        self.exited = True
+        sys.exit(0)
+
+    def help_EOF(self):
+        print 'Exit.'
+
+    def help_exit(self):
+        print 'Exit.'
+
+    def do_cd(self, line):
+        c = self.command
+        for name in line.split():
+            if name == '..':
+                c = c.parentCommand or c
+            elif name == '/':
+                c = c.getRootCommand()
+            else:
+                key = c._index.lookup(name.decode('utf-8'),
+                    c.allowAbbreviations)
+                if not isinstance(key, str):
+                    self.stdout.write("Unknown command '%s'.\n" % name)
+                    return
+                c = c.getSubCommand(key)
+
+        if not c._subCommandClasses:
+            self.stdout.write("'%s' has no subcommands.\n" % c.name)
+            return
+
+        # all our classes share a layout, so we can switch in place
+        self.__class__ = commandToCmdClass(c)
+
+    def help_cd(self):
+        print 'Enter the scope of a subcommand; .. leaves it, / leaves all.'
+
+    def complete_cd(self, text, line, begidx, endidx):
+        return self.command.getCompletions(line[3:begidx].split(), text)
+
+    def completedefault(self, text, line, begidx, endidx):
+        # readline splits words on - too, so find the whole word,
+        # and only return what comes after text's start
+        start = line.rfind(' ', 0, endidx) + 1
+        args = line[:start].split()
+        return [c[begidx - start:] for c in
+            self.command.getCompletions(args, line[start:endidx])]
+
+
 def commandToCmdClass(command):
     """
     @type  command: L{Command}
@@ -527,6 +1614,10 @@ def commandToCmdClass(command):
     implements a command line interpreter, using the commands under the given
     Command instance as its subcommands.
 
+    The class is created once per Command instance, and subcommands are
+    only created when they are first run.  The interpreter's cd command
+    switches it to the class of a subcommand.
+
     Example use in a command:
 
     >>> def do(self, args):
@@ -537,49 +1628,22 @@ def commandToCmdClass(command):
 
     @rtype: L{cmd.Cmd}
     """
-    import cmd
-
-    # internal class to subclass cmd.Cmd with a Ctrl-D handler
-
-    class _CommandWrappingCmd(cmd.Cmd):
-        prompt = '(command) '
-        exited = False
-        command = None # the original Command subclass
-
-        def __repr__(self):
-            return "<_CommandWrappingCmd for Command %r>" % self.command
+    if command._cmdClass is not None:
+        return command._cmdClass
 
-        def do_EOF(self, args):
-            self.stdout.write('\n')
-            self.exited = True
-            sys.exit(0)
+    # populate the Cmd interpreter from our command's subcommands
+    attributes = {'command': command}
 
-        def do_exit(self, args):
-            self.exited = True
-            sys.exit(0)
-
-        def help_EOF(self):
-            print 'Exit.'
-
-        def help_exit(self):
-            print 'Exit.'
-
-    # populate the Cmd interpreter from our command class
-    cmdClass = _CommandWrappingCmd
-    cmdClass.command = command
-
-    for name, subCommand in command.subCommands.items() \
-        + command.aliasedSubCommands.items():
-        if name == 'shell':
+    for key in command._index.complete(''):
+        if key == 'shell':
             continue
-        command.debug('Adding shell command %s for %r' % (name, subCommand))
+        name = command._index.lookup(key)
+        command.debug('Adding shell command %s for %s', key, name)
 
-        # add do command
-        methodName = 'do_' + name
-
-        def generateDo(c):
+        def generateDo(name):
 
             def do_(s, line):
+                c = command.getSubCommand(name)
                 # line is coming from a terminal; usually it is a utf-8 encoded
                 # string.
                 # Instead of making every Command subclass implement do with
@@ -588,20 +1652,14 @@ def commandToCmdClass(command):
                 # the do_ method is passed a single argument consisting of
                 # the remainder of the line
                 args = line.split(' ')
-                command.debug('Asking %r to parse %r' % (c, args))
+                command.debug('Asking %r to parse %r', c, args)
                 return c.parse(args)
             return do_
 
-        method = generateDo(subCommand)
-        setattr(cmdClass, methodName, method)
-
-
-        # add help command
-        methodName = 'help_' + name
-
-        def generateHelp(c):
+        def generateHelp(name):
 
             def help_(s):
+                c = command.getSubCommand(name)
                 # add a newline because we're still at the end of the help
                 # command on the prompt
                 c.debug('Getting help for %r', s)
@@ -609,12 +1667,14 @@ def commandToCmdClass(command):
                 c.parser.print_help(file=s.stdout)
             return help_
 
-        method = generateHelp(subCommand)
-        command.debug('Adding method %r with name %r to %r' % (
-            method, methodName, cmdClass))
-        setattr(cmdClass, methodName, method)
+        attributes['do_' + key] = generateDo(name)
+        attributes['help_' + key] = generateHelp(name)
 
-    return cmdClass
+    # cmd.Cmd is a classic class
+    command._cmdClass = types.ClassType(
+        '_CommandWrappingCmd_%s' % command.name,
+        (_CommandWrappingCmd, ), attributes)
+    return command._cmdClass
 
 
 def commandToCmd(command):
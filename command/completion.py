@@ -0,0 +1,219 @@
+# -*- Mode: Python; test-case-name: test_completion -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is released under the standard PSF license.
+
+"""
+Generate bash and zsh completion scripts for a command tree.
+
+The scripts have the names, aliases and options of every command in the
+tree embedded, so completing does not run the program.  Regenerate them
+when the tree changes.
+
+Example use, adding a subcommand to a program:
+
+>>> class Root(command.Command):
+...     subCommandClasses = [..., completion.Completion]
+
+after which users can install the script with, for example:
+
+  myprogram completion bash > /etc/bash_completion.d/myprogram
+"""
+
+import os
+import re
+import sys
+
+import command
+
+SHELLS = ['bash', 'zsh']
+
+# the part shared by bash and zsh; sets node to the command the words
+# before the current one lead to, or to -1 if they do not lead anywhere,
+# and skip if the current word is the value of an option
+_WALK = """\
+    local node=0 skip= i word
+    for ((i = %(first)s; i < %(current)s; i++)); do
+        word="${%(words)s[i]}"
+        if [ -n "$skip" ]; then
+            skip=
+            continue
+        fi
+        %(function)s_node $node
+        case "$word" in
+        -*=*)
+            continue;;
+        -*)
+            case " $%(function)s_valued " in
+            *" $word "*)
+                skip=1;;
+            esac
+            continue;;
+        esac
+        # arguments to a command without subcommands
+        if [ -z "$%(function)s_words" ]; then
+            continue
+        fi
+        %(function)s_child $node "$word"
+        node=$%(function)s_next
+    done
+    %(function)s_node $node
+"""
+
+_BASH = """\
+%(functions)s
+%(function)s()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}"
+%(walk)s
+    if [ -n "$skip" ]; then
+        COMPREPLY=( $(compgen -f -- "$cur") )
+    elif [[ "$cur" == -* ]]; then
+        COMPREPLY=( $(compgen -W "$%(function)s_options" -- "$cur") )
+    else
+        COMPREPLY=( $(compgen -W "$%(function)s_words" -- "$cur") )
+    fi
+}
+
+complete -F %(function)s %(program)s
+"""
+
+_ZSH = """\
+#compdef %(program)s
+
+%(functions)s
+%(function)s()
+{
+%(walk)s
+    if [ -n "$skip" ]; then
+        _files
+    elif [[ "${words[CURRENT]}" == -* ]]; then
+        compadd -- ${=%(function)s_options}
+    else
+        compadd -- ${=%(function)s_words}
+    fi
+}
+
+%(function)s "$@"
+"""
+
+
+def _quote(s):
+    return "'" + s.replace("'", "'\\''") + "'"
+
+
+def _walk(c, nodes, edges):
+    # add c and the commands below it; returns the number of c's node
+    number = len(nodes)
+    parser = c.parser
+    options = sorted(parser._short_opt.keys() + parser._long_opt.keys())
+    valued = sorted([o for o in options
+        if parser.get_option(o).takes_value()])
+    keys = c._index.complete('')
+    nodes.append((keys, options, valued))
+
+    children = {}
+    for name, subCommand in sorted(c.getSubCommands().items()):
+        children[name] = _walk(subCommand, nodes, edges)
+    for key in keys:
+        edges.append((number, key, children[c._index.lookup(key)]))
+
+    return number
+
+
+def _getFunctions(function, nodes, edges):
+    lines = []
+    lines.append('%s_node()' % function)
+    lines.append('{')
+    lines.append('    case "$1" in')
+    for number, (words, options, valued) in enumerate(nodes):
+        lines.append('    %d)' % number)
+        lines.append('        %s_words=%s' % (function,
+            _quote(' '.join(words))))
+        lines.append('        %s_options=%s' % (function,
+            _quote(' '.join(options))))
+        lines.append('        %s_valued=%s;;' % (function,
+            _quote(' '.join(valued))))
+    lines.append('    *)')
+    lines.append('        %s_words=' % function)
+    lines.append('        %s_options=' % function)
+    lines.append('        %s_valued=;;' % function)
+    lines.append('    esac')
+    lines.append('}')
+    lines.append('')
+    lines.append('%s_child()' % function)
+    lines.append('{')
+    lines.append('    case "$1 $2" in')
+    for number, key, child in edges:
+        lines.append('    %s)' % _quote('%d %s' % (number, key)))
+        lines.append('        %s_next=%d;;' % (function, child))
+    lines.append('    *)')
+    lines.append('        %s_next=-1;;' % function)
+    lines.append('    esac')
+    lines.append('}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def generate(root, shell='bash', program=None):
+    """
+    Generate a completion script for the given command tree.
+    This instantiates the whole tree.
+
+    @param root:    the root command of the program
+    @type  root:    L{command.Command}
+    @param shell:   one of L{SHELLS}
+    @type  shell:   str
+    @param program: the name of the program to complete;
+                    defaults to the name it was run with
+
+    @rtype: str
+    """
+    if shell not in SHELLS:
+        raise KeyError("Unknown shell %r" % shell)
+
+    if program is None:
+        program = os.path.basename(sys.argv[0])
+    function = '_' + re.sub('[^A-Za-z0-9_]', '_', program)
+
+    nodes = []
+    edges = []
+    _walk(root, nodes, edges)
+
+    values = {
+        'function': function,
+        'program': program,
+        'functions': _getFunctions(function, nodes, edges),
+    }
+    if shell == 'bash':
+        values['walk'] = _WALK % dict(values, first=1,
+            current='COMP_CWORD', words='COMP_WORDS')
+        return _BASH % values
+
+    values['walk'] = _WALK % dict(values, first=2,
+        current='CURRENT', words='words')
+    return _ZSH % values
+
+
+class Completion(command.Command):
+    usage = "[options] %s" % "|".join(SHELLS)
+    summary = "output a shell completion script"
+    description = """Output a completion script for this program for bash or zsh.
+
+For bash, source it or install it in /etc/bash_completion.d/.
+For zsh, install it as _<program> in a directory in $fpath."""
+
+    def addOptions(self):
+        self.parser.add_option('-p', '--program',
+            action="store", dest="program",
+            help="name of the program to complete (default: %s)" % (
+                os.path.basename(sys.argv[0])))
+
+    def do(self, args):
+        if len(args) != 1 or args[0] not in SHELLS:
+            self.stderr.write("Please specify one of %s.\n" % (
+                ", ".join(SHELLS)))
+            return 3
+
+        self.stdout.write(generate(self.getRootCommand(), args[0],
+            self.options.program))
@@ -0,0 +1,358 @@
+# -*- Mode: Python; test-case-name: test_daemon -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is released under the standard PSF license.
+
+"""
+A server that keeps a command tree resident and runs invocations sent
+to it over a Unix socket, and a client to send them.
+
+This lets programs that are invoked very often skip Python startup and
+the construction of the command tree.
+
+Example server:
+
+>>> server = daemon.Server(Root(), '/tmp/myprogram.socket', workers=4)
+>>> server.serve()
+
+Example client, as the program's main:
+
+>>> sys.exit(daemon.main('/tmp/myprogram.socket'))
+
+Each invocation gets parsed by the root command in one of the worker
+processes, with the client's arguments, working directory and the
+environment variables listed in L{ENVIRONMENT}.  Output to the command's
+stdout and stderr is sent back to the client as it is written.
+Standard input is not forwarded.
+
+Note that a L{tcommand.ReactorCommand} can only run its reactor once per
+process, so it can not be used as the root command of a server.
+"""
+
+import os
+import sys
+import errno
+import signal
+import socket
+import struct
+
+import command
+
+# environment variables forwarded by the client by default
+ENVIRONMENT = ['COLUMNS', 'HOME', 'LANG', 'LC_ALL', 'LOGNAME', 'PATH',
+    'TERM', 'TZ', 'USER']
+
+# message types; each message is its type, the length of its data
+# as a 4-byte big-endian integer, and its data
+REQUEST = 'R'
+STDOUT = 'O'
+STDERR = 'E'
+EXIT = 'X'
+
+_HEADER = '!cI'
+_HEADER_SIZE = struct.calcsize(_HEADER)
+
+
+def _send(connection, kind, data):
+    connection.sendall(struct.pack(_HEADER, kind, len(data)) + data)
+
+
+def _recvExactly(connection, size):
+    chunks = []
+    while size:
+        chunk = connection.recv(size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv(connection):
+    kind, size = struct.unpack(_HEADER,
+        _recvExactly(connection, _HEADER_SIZE))
+    return kind, _recvExactly(connection, size)
+
+
+class _ConnectionWriter(object):
+    """
+    I am a write-file-like object that sends what is written as
+    messages of the given kind over a connection.
+    """
+
+    softspace = 0
+
+    def __init__(self, connection, kind):
+        self._connection = connection
+        self._kind = kind
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            _send(self._connection, self._kind, data)
+
+    def writelines(self, lines):
+        self.write(''.join(lines))
+
+    def flush(self):
+        pass
+
+
+def preload(c):
+    """
+    Create all subcommands and option parsers of the given command,
+    so that forked workers share them instead of each creating them.
+
+    @type  c: L{command.Command}
+    """
+    c.parser
+    for subCommand in c.getSubCommands().values():
+        preload(subCommand)
+
+
+class Server(object):
+    """
+    I keep a command tree resident and run invocations sent to me over
+    a Unix socket, in a number of forked worker processes.
+
+    @ivar root:    the root command that parses each invocation
+    @type root:    L{command.Command}
+    @ivar path:    the path of the Unix socket
+    @type path:    str
+    @ivar workers: the number of worker processes
+    @type workers: int
+    @ivar environment: the environment variables clients may set;
+                   others they send are ignored
+    @type environment: list of str
+    """
+
+    _socket = None
+    _stopping = False
+
+    def __init__(self, root, path, workers=4, environment=None):
+        self.root = root
+        self.path = path
+        self.workers = workers
+        if environment is None:
+            environment = ENVIRONMENT
+        self.environment = environment
+        self._pids = []
+
+    def handle(self, connection):
+        """
+        Run the invocation sent over the given connection.
+        """
+        import json
+
+        kind, data = _recv(connection)
+        if kind != REQUEST:
+            return
+        request = json.loads(data)
+
+        cwd = os.getcwd()
+        environ = {}
+        for key, value in request['env'].items():
+            key = key.encode('utf-8')
+            # don't let clients set PYTHONPATH, LD_PRELOAD and the like
+            if key not in self.environment:
+                continue
+            environ[key] = os.environ.get(key)
+            os.environ[key] = value.encode('utf-8')
+
+        root = self.root
+        stdout = root._stdout
+        stderr = root._stderr
+        root._stdout = _ConnectionWriter(connection, STDOUT)
+        root._stderr = _ConnectionWriter(connection, STDERR)
+        try:
+            try:
+                os.chdir(request['cwd'])
+                root.reset()
+                ret = root.parse(request['argv']) or 0
+            except command.CommandExited, e:
+                # for example, an option error; like parseBatch() does
+                ret = e.status
+                if e.output is not None:
+                    if isinstance(e, command.CommandOk):
+                        root.stdout.write(e.output + '\n')
+                    else:
+                        root.stderr.write(e.output + '\n')
+            except SystemExit, e:
+                ret = e.code
+                if ret is None:
+                    ret = 0
+            except Exception:
+                import traceback
+                root.stderr.write(traceback.format_exc())
+                ret = 1
+        finally:
+            root._stdout = stdout
+            root._stderr = stderr
+            os.chdir(cwd)
+            for key, value in environ.items():
+                if value is None:
+                    del os.environ[key]
+                else:
+                    os.environ[key] = value
+
+        _send(connection, EXIT, str(ret))
+
+    def _work(self):
+        # a worker process; serve until killed
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        while True:
+            try:
+                connection, _ = self._socket.accept()
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            try:
+                try:
+                    self.handle(connection)
+                except (EOFError, socket.error):
+                    # the client went away
+                    pass
+            finally:
+                connection.close()
+
+    def _fork(self):
+        pid = os.fork()
+        if pid:
+            self._pids.append(pid)
+            return
+
+        try:
+            self._work()
+        finally:
+            os._exit(1)
+
+    def listen(self):
+        """
+        Create the Unix socket, replacing a stale one.
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self.path)
+        self._socket.listen(128)
+
+    def serve(self):
+        """
+        Listen, start the worker processes and restart them when they
+        die, until stop() is called or SIGTERM or SIGINT is received.
+        """
+        preload(self.root)
+        if not self._socket:
+            self.listen()
+
+        def handler(signum, frame):
+            self.stop()
+        signal.signal(signal.SIGTERM, handler)
+        signal.signal(signal.SIGINT, handler)
+
+        for i in range(self.workers):
+            self._fork()
+
+        try:
+            while not self._stopping:
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+
+                if pid in self._pids:
+                    self._pids.remove(pid)
+                    if not self._stopping:
+                        self._fork()
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        """
+        Stop serving; serve() will kill the workers and return.
+        """
+        self._stopping = True
+
+    def _shutdown(self):
+        for pid in self._pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self._pids = []
+
+        self._socket.close()
+        self._socket = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def call(path, argv, stdout=None, stderr=None, environment=None):
+    """
+    Send an invocation to the server listening on the given path,
+    and write its output to stdout and stderr as it arrives.
+
+    @param path:        the path of the server's Unix socket
+    @type  path:        str
+    @param argv:        the arguments for the root command
+    @type  argv:        list of str
+    @param environment: the environment variables to forward;
+                        defaults to L{ENVIRONMENT}
+    @type  environment: list of str
+
+    @rtype:   int
+    @returns: the exit code of the invocation
+    """
+    import json
+
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    if environment is None:
+        environment = ENVIRONMENT
+
+    env = {}
+    for key in environment:
+        if key in os.environ:
+            env[key] = os.environ[key]
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        _send(connection, REQUEST, json.dumps({
+            'argv': argv,
+            'cwd': os.getcwd(),
+            'env': env,
+        }))
+
+        while True:
+            kind, data = _recv(connection)
+            if kind == STDOUT:
+                stdout.write(data)
+            elif kind == STDERR:
+                stderr.write(data)
+            elif kind == EXIT:
+                try:
+                    return int(data)
+                except ValueError:
+                    # SystemExit with a message
+                    stderr.write(data + '\n')
+                    return 1
+    finally:
+        connection.close()
+
+
+def main(path):
+    """
+    Forward this program's invocation to the server listening on the
+    given path.
+
+    @rtype: int
+    """
+    return call(path, sys.argv[1:])
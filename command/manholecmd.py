@@ -19,8 +19,10 @@ import os
 import sys
 import cmd
 import code
+import time
 import termios
 import tty
+import collections
 
 from twisted.conch import recvline
 from twisted.internet import stdio, defer
@@ -33,19 +35,32 @@ class FileWrapper:
 
     Writes are translated into addOutput calls on an object passed to
     __init__.  Newlines are also converted from network to local style.
+    Writes are collected until flush() is called or size bytes are
+    waiting, and then converted and added in one call.
     """
 
     softspace = 0
     state = 'normal'
+    size = 8192
 
     def __init__(self, o):
         self.o = o
+        self._data = []
+        self._size = 0
 
     def flush(self):
-        pass
+        if not self._data:
+            return
+        data = ''.join(self._data)
+        self._data = []
+        self._size = 0
+        self.o.addOutput(data.replace('\r\n', '\n'))
 
     def write(self, data):
-        self.o.addOutput(data.replace('\r\n', '\n'))
+        self._data.append(data)
+        self._size += len(data)
+        if self._size >= self.size:
+            self.flush()
 
     def writelines(self, lines):
         self.write(''.join(lines))
@@ -72,15 +87,27 @@ class ManholeInterpreter(Interpreter, code.InteractiveInterpreter):
     which will format the unique identifier and the result with which the
     Deferred fires and then pass it on to the next participant in the
     callback chain.
+
+    Deferreds that have not fired yet can be listed with
+    pendingDeferreds() and cancelled with cancelDeferred(k) from the
+    interpreter.  Only the maxPendingDeferreds most recent ones are kept
+    track of.
     """
 
     numDeferreds = 0
+    maxPendingDeferreds = 1000
     buffer = None
+    _stdout = None # the FileWrapper for sys.stdout while running code
+    _source = None # the source being run
 
     def __init__(self, handler, locals=None, filename="<console>"):
         Interpreter.__init__(self, handler)
         code.InteractiveInterpreter.__init__(self, locals)
-        self._pendingDeferreds = {}
+        # id of deferred -> (k, deferred, creation time, source),
+        # oldest first
+        self._pendingDeferreds = collections.OrderedDict()
+        self.locals.setdefault('pendingDeferreds', self.pendingDeferreds)
+        self.locals.setdefault('cancelDeferred', self.cancelDeferred)
         self.filename = filename
         self.resetBuffer()
 
@@ -89,15 +116,21 @@ class ManholeInterpreter(Interpreter, code.InteractiveInterpreter):
     def runcode(self, *a, **kw):
         orighook, sys.displayhook = sys.displayhook, self.displayhook
         try:
-            origout, sys.stdout = sys.stdout, FileWrapper(self.handler)
+            self._stdout = FileWrapper(self.handler)
+            origout, sys.stdout = sys.stdout, self._stdout
             try:
                 code.InteractiveInterpreter.runcode(self, *a, **kw)
             finally:
                 sys.stdout = origout
+                self._stdout.flush()
+                self._stdout = None
         finally:
             sys.displayhook = orighook
 
     def write(self, data, async=False):
+        # keep the order with what was printed so far
+        if self._stdout is not None:
+            self._stdout.flush()
         self.handler.addOutput(data, async)
 
     ### Interpreter methods
@@ -122,6 +155,7 @@ class ManholeInterpreter(Interpreter, code.InteractiveInterpreter):
         """
         self.buffer.append(line)
         source = "\n".join(self.buffer)
+        self._source = source
         more = self.runsource(source, self.filename)
         if not more:
             self.resetBuffer()
@@ -142,26 +176,65 @@ class ManholeInterpreter(Interpreter, code.InteractiveInterpreter):
             else:
                 d = self._pendingDeferreds
                 k = self.numDeferreds
-                d[id(obj)] = (k, obj)
+                created = time.time()
+                d[id(obj)] = (k, obj, created, self._source)
                 self.numDeferreds += 1
+                # forget the oldest ones, which we would keep alive
+                while len(d) > self.maxPendingDeferreds:
+                    d.popitem(last=False)
                 obj.addCallbacks(
                     self._cbDisplayDeferred, self._ebDisplayDeferred,
-                    callbackArgs=(k, obj), errbackArgs=(k, obj))
+                    callbackArgs=(k, obj, created),
+                    errbackArgs=(k, obj, created))
                 self.write("<Deferred #%d>" % (k, ))
         elif obj is not None:
             self.write(repr(obj))
 
-    def _cbDisplayDeferred(self, result, k, obj):
-        self.write("Deferred #%d called back: %r" % (k, result), True)
-        del self._pendingDeferreds[id(obj)]
+    def _removePendingDeferred(self, k, obj):
+        # the id can be reused once a forgotten deferred is gone
+        entry = self._pendingDeferreds.get(id(obj))
+        if entry and entry[0] == k:
+            del self._pendingDeferreds[id(obj)]
+
+    def _cbDisplayDeferred(self, result, k, obj, created):
+        self.write("Deferred #%d called back after %.3f s: %r" % (
+            k, time.time() - created, result), True)
+        self._removePendingDeferred(k, obj)
         return result
 
-    def _ebDisplayDeferred(self, failure, k, obj):
-        self.write("Deferred #%d failed: %r" % (
-            k, failure.getErrorMessage()), True)
-        del self._pendingDeferreds[id(obj)]
+    def _ebDisplayDeferred(self, failure, k, obj, created):
+        self.write("Deferred #%d failed after %.3f s: %r" % (
+            k, time.time() - created, failure.getErrorMessage()), True)
+        self._removePendingDeferred(k, obj)
         return failure
 
+    def pendingDeferreds(self):
+        """
+        Write the Deferreds that have not fired yet, with their age and
+        the source that displayed them, oldest first.
+        """
+        if not self._pendingDeferreds:
+            self.write("No pending Deferreds.")
+            return
+
+        now = time.time()
+        lines = []
+        for k, obj, created, source in self._pendingDeferreds.values():
+            lines.append("#%-5d %10.3f s  %s" % (
+                k, now - created, (source or '?').replace('\n', ' ')))
+        self.write("\n".join(lines))
+
+    def cancelDeferred(self, k):
+        """
+        Cancel the pending Deferred with the given number.
+        """
+        for number, obj, created, source in self._pendingDeferreds.values():
+            if number == k:
+                obj.cancel()
+                return
+
+        self.write("No pending Deferred #%d." % (k, ))
+
 CTRL_C = '\x03'
 CTRL_D = '\x04'
 CTRL_BACKSLASH = '\x1c'
@@ -181,6 +254,14 @@ class Manhole(recvline.HistoricRecvLine):
     namespace = None
     interpreterClass = ManholeInterpreter
 
+    # asynchronous output is written at most once per reactor iteration,
+    # or when this many bytes are waiting
+    outputBufferSize = 8192
+
+    _asyncOutput = None # list of str waiting to be written
+    _asyncOutputSize = 0
+    _asyncOutputCall = None # delayed call to flushOutput()
+
     def __init__(self, namespace=None):
         recvline.HistoricRecvLine.__init__(self)
         if namespace is not None:
@@ -239,25 +320,77 @@ class Manhole(recvline.HistoricRecvLine):
         return not w.endswith('\n') and not w.endswith('\x1bE')
 
     def addOutput(self, bytes, async=False):
-        if async:
-            self.terminal.eraseLine()
-            self.terminal.cursorBackward(
-                len(self.lineBuffer) + len(self.ps[self.pn]))
+        """
+        Write output to the terminal.
 
-        self.terminal.write(bytes)
+        Asynchronous output, which arrives while the user may be typing,
+        is collected and written by flushOutput() with a single redraw of
+        the input line.
+        """
+        if not async:
+            # keep the order with asynchronous output still waiting
+            self.flushOutput()
+            self.terminal.write(bytes)
+            return
+
+        if self._asyncOutput is None:
+            self._asyncOutput = []
+        self._asyncOutput.append(bytes)
+        self._asyncOutputSize += len(bytes)
+
+        if self._asyncOutputSize >= self.outputBufferSize:
+            self.flushOutput()
+        elif self._asyncOutputCall is None:
+            from twisted.internet import reactor
+            self._asyncOutputCall = reactor.callLater(0, self.flushOutput)
 
-        if async:
-            if self._needsNewline():
-                self.terminal.nextLine()
+    def flushOutput(self):
+        """
+        Write the asynchronous output waiting to be written, erasing the
+        input line before and redrawing it after.
+        """
+        if self._asyncOutputCall is not None:
+            if self._asyncOutputCall.active():
+                self._asyncOutputCall.cancel()
+            self._asyncOutputCall = None
 
-            self.terminal.write(self.ps[self.pn])
+        if not self._asyncOutput:
+            return
+
+        # each piece of output used to get a line of its own
+        pieces = self._asyncOutput
+        self._asyncOutput = None
+        self._asyncOutputSize = 0
+        for i, piece in enumerate(pieces[:-1]):
+            if not piece.endswith('\n'):
+                pieces[i] = piece + '\n'
 
-            if self.lineBuffer:
-                oldBuffer = self.lineBuffer
-                self.lineBuffer = []
-                self.lineBufferIndex = 0
+        self.terminal.eraseLine()
+        self.terminal.cursorBackward(
+            len(self.lineBuffer) + len(self.ps[self.pn]))
 
-                self._deliverBuffer(oldBuffer)
+        self.terminal.write(''.join(pieces))
+
+        if self._needsNewline():
+            self.terminal.nextLine()
+
+        self.terminal.write(self.ps[self.pn])
+
+        if self.lineBuffer:
+            oldBuffer = self.lineBuffer
+            self.lineBuffer = []
+            self.lineBufferIndex = 0
+
+            # newer Twisted slices this as a string
+            self._deliverBuffer(''.join(oldBuffer))
+
+    def connectionLost(self, reason):
+        if self._asyncOutputCall is not None:
+            if self._asyncOutputCall.active():
+                self._asyncOutputCall.cancel()
+            self._asyncOutputCall = None
+        self._asyncOutput = None
+        recvline.HistoricRecvLine.connectionLost(self, reason)
 
     def lineReceivedErrback(self, failure):
         """
@@ -294,13 +427,15 @@ class CmdInterpreter(Interpreter):
     """
     cmdClass = None # subclasses should set this
 
-    # instance of self.cmdClass
+    # instance of self.cmdClass, used for the whole session
     _cmd = None
+    # the terminal self._cmd writes to, once we have one
+    _terminal = None
 
     def __init__(self, handler, localss=None):
         Interpreter.__init__(self, handler, localss)
         # this instantiation is so we can get the prompt; but we don't
-        # have self.handler.terminal yet
+        # have self.handler.terminal yet, so push() sets it on first use
         self._cmd = self.cmdClass()
         self.handler.ps = (self._cmd.prompt, '... ')
 
@@ -316,11 +451,17 @@ class CmdInterpreter(Interpreter):
 
         assert type(line) is not unicode
         # now we have self.handler.terminal
-        self._cmd = self.cmdClass(stdout=self.handler.terminal)
-        # set stdout on the root command too
+        terminal = self.handler.terminal
+        if self._terminal is not terminal:
+            self._cmd.stdout = terminal
+            self._terminal = terminal
+        # set stdout on the root command too, unless it is set already;
+        # other sessions can share the command tree
         # FIXME: pokes in internals
         if hasattr(self._cmd, 'command'):
-            self._cmd.command.getRootCommand()._stdout = self.handler.terminal
+            root = self._cmd.command.getRootCommand()
+            if root._stdout is not terminal:
+                root._stdout = terminal
         d = defer.maybeDeferred(self._cmd.onecmd, line)
         # according to the docs, 'The return value is a flag indicating whether
         # interpretation of commands by the interpreter should stop.'
@@ -338,7 +479,7 @@ class CmdInterpreter(Interpreter):
     def resetBuffer(self):
         pass
 
-    def debug(self, format, args):
+    def debug(self, format, *args):
         pass
 
 
@@ -362,6 +503,8 @@ class CmdManhole(Manhole):
 
         Override me for custom behaviour.
         """
+        Manhole.connectionLost(self, reason)
+
         if not self.connectionLostDeferred:
             # FIXME: should we really be handling the reactor here?
             from twisted.internet import reactor
@@ -0,0 +1,130 @@
+# -*- Mode: Python; test-case-name: test_pool -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+# This file is released under the standard PSF license.
+
+"""
+Run batches of independent command lines in parallel, in a pool of
+worker processes that each have their own copy of the command tree.
+
+Workers get their copy of the tree by forking, so this only works on
+platforms that have fork().
+"""
+
+import sys
+import shlex
+import StringIO
+
+import command
+
+# the root command in a worker process
+_root = None
+
+
+def _initialize(root):
+    global _root
+    _root = root
+
+
+def _run(task):
+    index, argv = task
+
+    out = StringIO.StringIO()
+    err = StringIO.StringIO()
+    _root.reset()
+    _root._stdout = out
+    _root._stderr = err
+    try:
+        try:
+            ret = _root.parse(argv) or 0
+        except command.CommandExited, e:
+            # for example, an option error; like parseBatch() does
+            ret = e.status
+            if e.output is not None:
+                if isinstance(e, command.CommandOk):
+                    out.write(e.output + '\n')
+                else:
+                    err.write(e.output + '\n')
+        except SystemExit, e:
+            ret = e.code or 0
+            if not isinstance(ret, int):
+                # exited with a message
+                err.write('%s\n' % (ret, ))
+                ret = 1
+        except Exception:
+            import traceback
+            err.write(traceback.format_exc())
+            ret = 1
+    finally:
+        _root._stdout = None
+        _root._stderr = None
+
+    return index, ret, out.getvalue(), err.getvalue()
+
+
+class BatchPool(object):
+    """
+    I run command lines through a root command in a pool of worker
+    processes, capturing the output of each one separately.
+
+    @ivar root:      the root command that parses each command line
+    @type root:      L{command.Command}
+    @ivar processes: the number of worker processes;
+                     defaults to the number of CPUs
+    @type processes: int
+    """
+
+    def __init__(self, root, processes=None):
+        self.root = root
+        self.processes = processes
+
+    def run(self, lines, ordered=True, stdout=None, stderr=None,
+            chunksize=1):
+        """
+        Run the given command lines in parallel, writing the output of
+        each to stdout and stderr as it completes.
+
+        @param lines:   command lines, split like a shell would;
+                        empty lines and comments are skipped
+        @type  lines:   iterable of str
+        @param ordered: whether to write output in the order of the
+                        lines, instead of in the order they complete
+        @type  ordered: bool
+
+        @rtype:   list of (str, int)
+        @returns: each command line that was run, with its exit code,
+                  in the order of the lines
+        """
+        import multiprocessing
+
+        stdout = stdout or sys.stdout
+        stderr = stderr or sys.stderr
+
+        tasks = []
+        stripped = []
+        for line in lines:
+            argv = shlex.split(line, comments=True)
+            if argv:
+                tasks.append((len(tasks), argv))
+                stripped.append(line.strip())
+
+        rets = [None] * len(tasks)
+        pool = multiprocessing.Pool(self.processes, _initialize,
+            (self.root, ))
+        try:
+            if ordered:
+                results = pool.imap(_run, tasks, chunksize)
+            else:
+                results = pool.imap_unordered(_run, tasks, chunksize)
+
+            for index, ret, out, err in results:
+                stdout.write(out)
+                stderr.write(err)
+                rets[index] = (stripped[index], ret)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return rets
+
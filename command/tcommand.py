@@ -16,8 +16,22 @@ class TwistedCommand(command.Command):
 
     Instead of implementing the do() method, subclasses should implement a
     doLater() method which returns a deferred.
+
+    To do the same thing for many items concurrently, for example for
+    each host given as an argument:
+
+    >>> def doLater(self, args):
+    ...     d = self.doLaterMany(args, self.doLaterHost)
+    ...     d.addCallback(self.checkResults)
+    ...     return d
+
+    @cvar concurrency: the default maximum number of calls that
+                       doLaterMany() has outstanding at once
+    @type concurrency: int
     """
 
+    concurrency = 10
+
     def installReactor(self, reactor=None):
         """
         Override me to install your own reactor in the parent
@@ -38,6 +52,73 @@ class TwistedCommand(command.Command):
 
         c.installReactor(reactor)
 
+    def doLaterMany(self, items, function, concurrency=None):
+        """
+        Call function with each of the given items, with at most
+        concurrency calls outstanding at once.
+
+        @param function:    called with an item; can return a deferred
+        @param concurrency: defaults to self.concurrency
+        @type  concurrency: int
+
+        @rtype:   L{defer.Deferred}
+        @returns: a deferred firing with a list of
+                  (item, succeeded, result or failure), in the order
+                  of the items, once all calls are done
+        """
+        semaphore = defer.DeferredSemaphore(concurrency or self.concurrency)
+
+        def cb(result, item):
+            return (item, True, result)
+
+        def eb(failure, item):
+            if failure.check(command.CommandOk):
+                return (item, True, failure.value.output)
+            self.debug('doLaterMany: %r failed: %r', item,
+                command.Lazy(failure.getErrorMessage))
+            return (item, False, failure)
+
+        ds = []
+        for item in items:
+            d = semaphore.run(function, item)
+            d.addCallbacks(cb, eb, callbackArgs=(item, ),
+                errbackArgs=(item, ))
+            ds.append(d)
+
+        return defer.gatherResults(ds)
+
+    def checkResults(self, results):
+        """
+        Report the failures in the results of doLaterMany() on stderr.
+
+        @raises command.CommandExited: if any item failed, with the status
+                                       of the first failure if it was a
+                                       CommandExited, or 1.
+        @returns: the results, if all items succeeded
+        """
+        status = None
+        failed = 0
+        for item, succeeded, result in results:
+            if succeeded:
+                continue
+
+            failed += 1
+            if result.check(command.CommandExited):
+                message = result.value.output
+                if status is None:
+                    status = result.value.status
+            else:
+                message = result.getErrorMessage()
+                if status is None:
+                    status = 1
+            self.stderr.write('%s: %s\n' % (item, message))
+
+        if failed:
+            raise command.CommandExited(status,
+                '%d of %d failed.' % (failed, len(results)))
+
+        return results
+
     ### command.Command implementations
     def do(self, args):
         self.debug('%r: installing reactor using method %r', self,
@@ -60,11 +141,99 @@ class ReactorCommand(command.Command):
     """
     I am a Command that runs a reactor for its subcommands if they
     return a L{defer.Deferred} from their doLater() method.
+
+    Since a reactor can only be run once per process, I can only parse
+    once that way.  To parse many times, run the reactor with
+    startReactor() instead; parse() then returns deferreds for the results
+    of subcommands that return deferreds, and stopReactor() stops it.
     """
 
     reactor = None
     returnValue = None
     _reactorRunning = False
+    _pending = None # deferreds returned by parse() that have not fired
+
+    def startReactor(self, main=None, *args, **kwargs):
+        """
+        Run the reactor until stopReactor() is called, so that parse() can
+        be called any number of times while it runs.
+
+        @param main: called with args and kwargs once the reactor runs;
+                     can return a deferred
+        """
+        if not self.reactor:
+            self.installReactor()
+
+        if main:
+            def run():
+                d = defer.maybeDeferred(main, *args, **kwargs)
+
+                def eb(failure):
+                    self.warning('startReactor: %r failed: %r\n%s\n',
+                        main, command.Lazy(failure.getErrorMessage),
+                        command.Lazy(failure.getTraceback))
+                    return failure
+                d.addErrback(eb)
+            self.reactor.callWhenRunning(run)
+
+        self.debug('startReactor: running reactor %r', self.reactor)
+        self.reactor.run()
+        self.debug('startReactor: ran reactor %r', self.reactor)
+
+    def stopReactor(self):
+        """
+        Stop the reactor started with startReactor(), once the deferreds
+        returned by parse() so far have fired.
+
+        @rtype: L{defer.Deferred}
+        """
+        pending = self._pending or []
+        self.debug('stopReactor: waiting for %d deferreds', len(pending))
+        d = defer.DeferredList(pending[:])
+
+        def stop(_):
+            self.debug('stopReactor: stopping reactor %r', self.reactor)
+            self.reactor.stop()
+        d.addCallback(stop)
+        return d
+
+    def _parseRunning(self, d):
+        """
+        Map the result of the given deferred to an exit code, with the
+        reactor already running.
+        """
+
+        def parseCb(ret):
+            if ret is None:
+                self.debug('parse returned None, defaults to exit code 0')
+                ret = 0
+            return ret
+
+        def parseEb(failure):
+            self.debug('parse: eb: failure: %r\n%s\n',
+                command.Lazy(failure.getErrorMessage),
+                command.Lazy(failure.getTraceback))
+
+            if failure.check(command.CommandExited):
+                if failure.value.output is not None:
+                    self.stderr.write(failure.value.output + '\n')
+                return failure.value.status
+
+            self.warning('errback: %r', failure.getErrorMessage())
+            self.stderr.write('Failure: %s\n' % failure.value)
+            return failure
+
+        def done(result):
+            self._pending.remove(d)
+            return result
+
+        if self._pending is None:
+            self._pending = []
+        self._pending.append(d)
+
+        d.addCallbacks(parseCb, parseEb)
+        d.addBoth(done)
+        return d
 
     def installReactor(self, reactor=None):
         """
@@ -81,7 +250,11 @@ class ReactorCommand(command.Command):
     def parse(self, argv):
         """
         I will run a reactor to get the non-deferred result.
+
+        If the reactor is already running, I return a deferred for the
+        exit code instead.
         """
+        self.returnValue = None
         self.debug('parse: chain up')
         try:
             r = command.Command.parse(self, argv)
@@ -89,7 +262,8 @@ class ReactorCommand(command.Command):
             # get a full traceback to debug here
             f = failure.Failure()
             self.warning('Exception during %r.parse: %r\n%s\n',
-                self, f.getErrorMessage(), f.getTraceback())
+                self, command.Lazy(f.getErrorMessage),
+                command.Lazy(f.getTraceback))
             self.stderr.write('Exception: %s\n' % f.value)
             raise
 
@@ -106,12 +280,16 @@ class ReactorCommand(command.Command):
         if not self.reactor:
             self.installReactor()
 
+        if self.reactor.running:
+            self.debug('parse: reactor already running, returning %r', d)
+            return self._parseRunning(d)
+
         def parseCb(ret):
             if ret is None:
                 self.debug('parse returned None, defaults to exit code 0')
                 ret = 0
             elif ret:
-                self.debug('parse returned %r' % ret)
+                self.debug('parse returned %r', ret)
             elif self.parser.help_printed or self.parser.usage_printed:
                 ret = 0
             self.debug('parse: cb: done')
@@ -124,7 +302,8 @@ class ReactorCommand(command.Command):
 
         def parseEb(failure):
             self.debug('parse: eb: failure: %r\n%s\n',
-                failure.getErrorMessage(), failure.getTraceback())
+                command.Lazy(failure.getErrorMessage),
+                command.Lazy(failure.getTraceback))
 
             # we can get here even before we run the reactor below;
             # so schedule a stop instead of doing it here
@@ -132,7 +311,8 @@ class ReactorCommand(command.Command):
             self.reactor.callLater(0, self.reactor.stop)
 
             if failure.check(command.CommandExited):
-                self.stderr.write(failure.value.output + '\n')
+                if failure.value.output is not None:
+                    self.stderr.write(failure.value.output + '\n')
                 reason = failure.value.status
                 self.returnValue = reason
                 return reason
@@ -152,7 +332,7 @@ class ReactorCommand(command.Command):
                 raise self.returnValue.value
 
         if self.returnValue is not None:
-            self.debug('got return value before reactor ran, returning %r' %
+            self.debug('got return value before reactor ran, returning %r',
                 self.returnValue)
             raiseIfFailure()
             return self.returnValue
@@ -160,7 +340,7 @@ class ReactorCommand(command.Command):
         self.debug('running reactor %r', self.reactor)
         self._reactorRunning = True
         self.reactor.run()
-        self.debug('ran reactor, got %r' % self.returnValue)
+        self.debug('ran reactor, got %r', self.returnValue)
         raiseIfFailure()
-        self.debug('ran reactor, returning %r' % self.returnValue)
+        self.debug('ran reactor, returning %r', self.returnValue)
         return self.returnValue
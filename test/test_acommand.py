@@ -0,0 +1,101 @@
+# -*- Mode: Python; test-case-name: test_acommand -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import json
+import unittest
+import StringIO
+
+try:
+    from command import acommand
+    from trollius import From, Return
+except ImportError:
+    acommand = None
+
+from command import command
+
+
+if acommand:
+    asyncio = acommand.asyncio
+
+    class Sleep(acommand.AsyncCommand):
+        summary = "Sleep"
+
+        @asyncio.coroutine
+        def doLater(self, args):
+            # uses the default loop
+            yield From(asyncio.sleep(0.01))
+            self.stdout.write('slept\n')
+            raise Return(int(args[0]))
+
+    class Fail(acommand.AsyncCommand):
+        summary = "Fail"
+
+        @asyncio.coroutine
+        def doLater(self, args):
+            yield From(asyncio.sleep(0))
+            raise command.CommandError('bad thing')
+
+    class Ok(acommand.AsyncCommand):
+        summary = "Ok"
+
+        @asyncio.coroutine
+        def doLater(self, args):
+            yield From(asyncio.sleep(0))
+            raise command.CommandOk('fine')
+
+    class Loop(acommand.LoopCommand):
+        summary = "Loop"
+        allowJSON = True
+        subCommandClasses = [Sleep, Fail, Ok]
+
+
+class LoopCommandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        if not acommand:
+            raise unittest.SkipTest('neither asyncio nor trollius')
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.c = Loop(stdout=self.out, stderr=self.err)
+
+    def tearDown(self):
+        if acommand:
+            self.c.close()
+        unittest.TestCase.tearDown(self)
+
+    def testSleep(self):
+        # fail instead of hanging when the sleep uses another loop
+        loop = self.c.getLoop()
+        loop.call_later(5, loop.stop)
+        self.assertEquals(self.c.parse(['sleep', '2']), 2)
+        self.assertEquals(self.out.getvalue(), 'slept\n')
+
+    def testParseAgain(self):
+        self.assertEquals(self.c.parse(['sleep', '0']), 0)
+        self.assertEquals(self.c.parse(['sleep', '1']), 1)
+
+    def testFail(self):
+        self.assertEquals(self.c.parse(['fail']), 3)
+        self.assertEquals(self.err.getvalue(), 'bad thing\n')
+
+    def testJSON(self):
+        self.assertEquals(self.c.parse(['--json', 'fail']), 3)
+        self.assertEquals(self.err.getvalue(), '')
+        self.assertEquals(
+            [json.loads(l) for l in self.out.getvalue().splitlines()],
+            [{'error': 'bad thing', 'status': 3}, {'exit': 3}])
+
+    def testJSONOk(self):
+        self.assertEquals(self.c.parse(['--json', 'ok']), 0)
+        self.assertEquals(
+            [json.loads(l) for l in self.out.getvalue().splitlines()],
+            [{'output': 'fine'}, {'exit': 0}])
+
+    def testNoLoop(self):
+        self.c.close()
+        self.assertRaises(AssertionError, Sleep().getLoop)
+
+
+if __name__ == '__main__':
+    unittest.main()
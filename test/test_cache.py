@@ -0,0 +1,100 @@
+# -*- Mode: Python; test-case-name: test_cache -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import os
+import shutil
+import tempfile
+import unittest
+import StringIO
+
+from command import cache
+
+from test import test_command
+
+
+class CommandCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.json')
+        # the root path is not importable, proving that the cache
+        # does not need it
+        self.cache = cache.CommandCache(self.path, 'test.nonexistent:Root')
+        self.cache.write(test_command.FakeCommand())
+        self.cache = cache.CommandCache(self.path, 'test.nonexistent:Root')
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        unittest.TestCase.tearDown(self)
+
+    def parse(self, argv):
+        return self.cache.parse(argv, stdout=self.out, stderr=self.err)
+
+    def testHelp(self):
+        out = StringIO.StringIO()
+        test_command.FakeCommand(stdout=out).parse(
+            ['fakesubcommand', '--help'])
+
+        self.assertEquals(self.parse(['fakesubcommand', '--help']), None)
+        self.assertEquals(self.out.getvalue(), out.getvalue())
+
+    def testUnknown(self):
+        err = StringIO.StringIO()
+        test_command.FakeCommand(stderr=err).parse(['unknown'])
+
+        self.assertEquals(self.parse(['unknown']), 1)
+        self.assertEquals(self.err.getvalue(), err.getvalue())
+
+    def testAlias(self):
+        path, action, args = self.cache.route(
+            ['fakesubcommand', 'f', '-h'])
+        self.assertEquals([n['name'] for n in path],
+            ['fakecommand', 'fakesubcommand', 'fakesubsubcommand'])
+        self.assertEquals(action, 'help')
+
+    def testMiss(self):
+        self.assertRaises(cache.CacheMiss, self.parse,
+            ['fakesubcommand', 'fakesubsubcommand'])
+        self.assertRaises(cache.CacheMiss, self.parse, ['--unknown'])
+
+    def testStale(self):
+        self.failIf(self.cache.load() is None)
+        c = cache.CommandCache(self.path, 'test.nonexistent:Other')
+        self.failUnless(c.load() is None)
+
+    def testMain(self):
+        os.unlink(self.path)
+        ret = cache.main('test.test_command:FakeCommand', self.path,
+            ['fakesubcommand', 'fakesubsubcommand', '--help'],
+            stdout=self.out, stderr=self.err)
+        self.assertEquals(ret, None)
+        self.failUnless(os.path.exists(self.path))
+        self.failUnless(self.out.getvalue().startswith('Usage: fake') or
+            self.out.getvalue().startswith('usage: fake'))
+
+    def testMainNotCached(self):
+        # a reference that can not be imported keeps us from caching,
+        # but not from running
+        os.unlink(self.path)
+        ret = cache.main('test.test_command:ReferenceCommand', self.path,
+            ['--help'], stdout=self.out, stderr=self.err)
+        self.assertEquals(ret, None)
+        self.failIf(os.path.exists(self.path))
+        self.failUnless(self.out.getvalue().find('Not importable') > -1)
+
+    def testRootOptions(self):
+        # --json, --timings and --batch change the output of parse()
+        self.cache.write(test_command.StructuredCommand())
+        for argv in (['--json', '--help'], ['--json', 'nope'],
+                ['--batch', 'file']):
+            self.assertRaises(cache.CacheMiss, self.parse, argv)
+        self.cache.write(test_command.TimingsCommand())
+        self.assertRaises(cache.CacheMiss, self.parse, ['--timings', 'nope'])
+        self.assertEquals(self.parse(['nope']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
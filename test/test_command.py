@@ -17,7 +17,10 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Street #330, Boston, MA 02111-1307, USA.
 
+import os
 import sys
+import optparse
+import tempfile
 import unittest
 import StringIO
 
@@ -96,5 +99,787 @@ class FakeSubCommandTestCase(unittest.TestCase):
             "out %r does not contain %s" % (self.out.getvalue(), lookFor))
 
 
+class StreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.c = FakeCommand()
+        self.leaf = self.c.subCommands['fakesubcommand'].subCommands[
+            'fakesubsubcommand']
+
+    def testDefault(self):
+        self.failUnless(self.leaf.stdout is sys.stdout)
+        out = StringIO.StringIO()
+        orig, sys.stdout = sys.stdout, out
+        try:
+            self.failUnless(self.leaf.stdout is out)
+        finally:
+            sys.stdout = orig
+
+    def testRedirectRoot(self):
+        self.failUnless(self.leaf.stderr is sys.stderr)
+        err = StringIO.StringIO()
+        self.c._stderr = err
+        self.failUnless(self.leaf.stderr is err)
+        self.failUnless(self.leaf.stdout is sys.stdout)
+
+        self.c._stderr = None
+        self.failUnless(self.leaf.stderr is sys.stderr)
+
+    def testRedirectedHelp(self):
+        self.leaf.parser
+        out = StringIO.StringIO()
+        self.c._stdout = out
+        self.c.parse(['fakesubcommand', 'fakesubsubcommand', '--help'])
+        self.failUnless(out.getvalue())
+
+
+class HelpCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.c = FakeCommand()
+
+    def testCached(self):
+        help = self.c.parser.format_help()
+        self.failUnless(self.c.parser.format_help() is help)
+
+    def testOptionAdded(self):
+        help = self.c.parser.format_help()
+        self.c.parser.add_option('-n', '--new', help='new option')
+        self.failUnless(self.c.parser.format_help().find('new option') > -1)
+
+        group = optparse.OptionGroup(self.c.parser, 'Group')
+        self.c.parser.add_option_group(group)
+        group.add_option('-g', '--group', help='group option')
+        self.failUnless(self.c.parser.format_help().find('group option') > -1)
+
+    def testCommandAdded(self):
+        self.c.parser.format_help()
+        self.c.parser.formatter.addCommand('added', 'Added command')
+        self.failUnless(self.c.parser.format_help().find('Added') > -1)
+        self.failUnless(
+            self.c.parser.formatter.getCommands().find('Added') > -1)
+
+
+class LazyCommand(command.Command):
+    description = "Lazy command"
+    lazySubCommands = True
+    subCommandClasses = [FakeSubCommand, ]
+
+
+class LazyCommandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.c = LazyCommand(stdout=self.out, stderr=self.err)
+
+    def testNotInstantiated(self):
+        self.assertEquals(self.c.subCommands, {})
+
+    def testHelpCommands(self):
+        self.assertEquals(None, self.c.parse(['--help', ]))
+        self.failUnless(self.out.getvalue().find("fakesubcommand  ") > -1)
+        self.assertEquals(self.c.subCommands, {})
+
+    def testDispatch(self):
+        self.assertEquals(None,
+            self.c.parse(['fakesubcommand', 'fakesubsubcommand', '--help']))
+        self.assertEquals(self.c.subCommands.keys(), ['fakesubcommand'])
+        sub = self.c.subCommands['fakesubcommand']
+        self.failUnless(sub.parentCommand is self.c)
+        self.failUnless(sub.stdout is self.out)
+
+    def testParsersOnPath(self):
+        self.c.parse(['fakesubcommand', 'fakesubsubcommand', '--help'])
+        sub = self.c.subCommands['fakesubcommand']
+        self.failIf(self.c._parser is None)
+        self.failIf(sub._parser is None)
+        self.failIf(sub.subCommands['fakesubsubcommand']._parser is None)
+
+    def testParserNotCreated(self):
+        sub = self.c.getSubCommand('fakesubcommand')
+        self.failUnless(sub._parser is None)
+        self.failUnless(self.c._parser is None)
+
+    def testGetSubCommands(self):
+        self.assertEquals(self.c.getSubCommands().keys(), ['fakesubcommand'])
+        self.failUnless(self.c.getSubCommand('nonexistent') is None)
+
+
+class ReferenceCommand(command.Command):
+    description = "Reference command"
+    lazySubCommands = True
+    subCommandClasses = [
+        command.CommandReference('test.test_command:FakeSubSubCommand',
+            aliases=['fssc', ], summary='Referenced subcommand'),
+        command.CommandReference('test.nonexistent:Nonexistent',
+            summary='Not importable'),
+    ]
+
+
+class ReferenceCommandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.c = ReferenceCommand(stdout=self.out, stderr=self.err)
+
+    def testHelpCommands(self):
+        self.assertEquals(None, self.c.parse(['--help', ]))
+        out = self.out.getvalue()
+        self.failUnless(out.find("fakesubsubcommand  Referenced") > -1)
+        self.failUnless(out.find("nonexistent        Not importable") > -1)
+        self.failIf('test.nonexistent' in sys.modules)
+
+    def testDispatch(self):
+        self.assertEquals(None, self.c.parse(['fssc', '--help', ]))
+        sub = self.c.getSubCommand('fakesubsubcommand')
+        self.failUnless(isinstance(sub, FakeSubSubCommand))
+
+    def testImportOnDispatch(self):
+        self.assertRaises(ImportError, self.c.parse, ['nonexistent', ])
+
+
+class Show(command.Command):
+    summary = "Show"
+
+    def do(self, args):
+        self.stdout.write('show\n')
+
+
+class Set(command.Command):
+    summary = "Set"
+
+
+class Config(command.Command):
+    summary = "Config"
+    allowAbbreviations = True
+    subCommandClasses = [Show, Set]
+
+
+class Connect(command.Command):
+    summary = "Connect"
+    aliases = ['link', ]
+
+
+class AbbreviationCommand(command.Command):
+    summary = "Abbreviation command"
+    allowAbbreviations = True
+    subCommandClasses = [Config, Connect]
+
+
+class AbbreviationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.c = AbbreviationCommand(stdout=self.out, stderr=self.err)
+
+    def testPrefix(self):
+        self.assertEquals(self.c.parse(['conf', 'sh']), 0)
+        self.assertEquals(self.out.getvalue(), 'show\n')
+
+    def testAmbiguous(self):
+        self.assertEquals(self.c.parse(['con']), 1)
+        self.assertEquals(self.err.getvalue(),
+            "Ambiguous command 'con', could be config, connect.\n")
+
+    def testAliasPrefix(self):
+        self.assertEquals(self.c._index.lookup('li', True), 'connect')
+
+    def testNoAbbreviations(self):
+        index = command.CommandIndex()
+        index.add('config')
+        self.assertEquals(index.lookup('conf'), None)
+        self.assertEquals(index.lookup('config'), 'config')
+
+    def testCollision(self):
+        index = command.CommandIndex()
+        index.add('config', ['c', ])
+        self.assertRaises(AttributeError, index.add, 'connect', ['c', ])
+
+    def testSameName(self):
+
+        class Other(command.Command):
+            name = 'show'
+
+        class Duplicate(command.Command):
+            summary = "Duplicate"
+            subCommandClasses = [Show, Other]
+
+        self.assertRaises(AttributeError, Duplicate)
+
+
+class Log(command.Command):
+    summary = "Log"
+
+    def addOptions(self):
+        self.parser.add_option('-l', '--level',
+            action="store", dest="level")
+        self.parser.add_option('-v', '--verbose',
+            action="store_true", dest="verbose")
+
+
+class CompletionCommand(command.Command):
+    summary = "Completion command"
+    lazySubCommands = True
+    subCommandClasses = [Config, Connect, Log]
+
+
+class CompletionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.c = CompletionCommand()
+
+    def testNames(self):
+        self.assertEquals(self.c.getCompletions([], 'c'),
+            ['config', 'connect'])
+        self.assertEquals(self.c.getCompletions([], 'l'), ['link', 'log'])
+        self.assertEquals(self.c.getCompletions([], 'x'), [])
+        self.assertEquals(self.c.subCommands, {})
+
+    def testNested(self):
+        self.assertEquals(self.c.getCompletions(['config'], ''),
+            ['set', 'show'])
+        self.assertEquals(self.c.getCompletions(['unknown'], ''), [])
+        self.assertEquals(self.c.subCommands.keys(), ['config'])
+
+    def testOptions(self):
+        self.assertEquals(self.c.getCompletions(['log'], '--'),
+            ['--help', '--level', '--verbose'])
+        self.assertEquals(self.c.getCompletions([], '--h'), ['--help'])
+
+    def testOptionValues(self):
+        # the value of --level is not taken for a subcommand
+        self.assertEquals(self.c.getCompletions(['log', '--level', 'x'],
+            '-v'), ['-v'])
+
+    def testShell(self):
+        shell = command.commandToCmdClass(self.c)()
+        self.assertEquals(shell.completenames('con'), ['config', 'connect'])
+        line = 'config s'
+        self.assertEquals(shell.completedefault('s', line, 7, 8),
+            ['set', 'show'])
+        # readline gives us the text after the dashes
+        line = 'log --ver'
+        self.assertEquals(shell.completedefault('ver', line, 6, 9),
+            ['verbose'])
+
+
+class ShellTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = StringIO.StringIO()
+        self.c = CompletionCommand(stdout=self.out)
+        self.shell = command.commandToCmdClass(self.c)(stdout=self.out)
+
+    def testCached(self):
+        self.failUnless(command.commandToCmdClass(self.c) is
+            self.shell.__class__)
+        other = command.commandToCmdClass(FakeCommand())
+        self.failIf(other is self.shell.__class__)
+        self.failUnless(hasattr(other, 'do_fakesubcommand'))
+        self.failIf(hasattr(self.shell, 'do_fakesubcommand'))
+
+    def testLazy(self):
+        self.failUnless(hasattr(self.shell, 'do_link'))
+        self.assertEquals(self.c.subCommands, {})
+
+    def testCd(self):
+        self.shell.onecmd('cd config')
+        self.failUnless(self.shell.command is self.c.getSubCommand('config'))
+        self.shell.onecmd('show')
+        self.assertEquals(self.out.getvalue(), 'show\n')
+        self.shell.onecmd('cd ..')
+        self.failUnless(self.shell.command is self.c)
+        self.shell.onecmd('cd config')
+        self.shell.onecmd('cd /')
+        self.failUnless(self.shell.command is self.c)
+
+    def testCdErrors(self):
+        self.shell.onecmd('cd log')
+        self.shell.onecmd('cd unknown')
+        self.failUnless(self.shell.command is self.c)
+        self.assertEquals(self.out.getvalue(),
+            "'log' has no subcommands.\nUnknown command 'unknown'.\n")
+
+
+class Fail(command.Command):
+    summary = "Fail"
+
+    def do(self, args):
+        raise command.CommandError('failed')
+
+
+class BatchCommand(command.Command):
+    summary = "Batch command"
+    allowBatch = True
+    subCommandClasses = [Show, Fail]
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.c = BatchCommand(stdout=self.out, stderr=self.err)
+
+    def testParseBatch(self):
+        rets = self.c.parseBatch(['show', '', '# comment', 'fail',
+            'show --help'])
+        self.assertEquals(rets, [('show', 0), ('fail', 3),
+            ('show --help', 0)])
+        self.failUnless(self.out.getvalue().startswith('show\n'))
+        self.failUnless(
+            self.out.getvalue().lower().find('usage: batchcommand show') > -1)
+        self.assertEquals(self.c.options, None)
+        self.failIf(self.c.subCommands['show'].parser.help_printed)
+
+    def testOptionError(self):
+        rets = self.c.parseBatch(['show', 'show --bogus', 'show'])
+        self.assertEquals(rets, [('show', 0), ('show --bogus', 3),
+            ('show', 0)])
+        self.assertEquals(self.out.getvalue(), 'show\nshow\n')
+        self.failUnless(
+            self.err.getvalue().endswith('no such option: --bogus\n'))
+
+    def testBatchOption(self):
+        path = tempfile.mktemp()
+        handle = open(path, 'w')
+        handle.write('show\nfail\nshow\n')
+        handle.close()
+        try:
+            self.assertEquals(self.c.parse(['--batch', path]), 3)
+        finally:
+            os.unlink(path)
+        self.assertEquals(self.out.getvalue(), 'show\nshow\n')
+        self.assertEquals(self.err.getvalue(),
+            "failed\n'fail' exited with 3.\n")
+
+    def testNestedBatch(self):
+        path = tempfile.mktemp()
+        handle = open(path, 'w')
+        handle.write('show\n--batch %s\nshow\n' % path)
+        handle.close()
+        try:
+            self.assertEquals(self.c.parse(['--batch', path]), 1)
+        finally:
+            os.unlink(path)
+        self.assertEquals(self.out.getvalue(), 'show\nshow\n')
+        self.assertEquals(self.err.getvalue(),
+            "--batch can not be used in a batch.\n"
+            "'--batch %s' exited with 1.\n" % path)
+        self.failIf(self.c._inBatch)
+
+
+class FakeFuture(object):
+    """
+    I am the part of a future that commands use, calling callbacks
+    when my result is set.
+    """
+
+    def __init__(self):
+        self._callbacks = []
+        self._result = None
+
+    def add_done_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self._result = result
+        for callback in self._callbacks:
+            callback(self)
+
+    def cancelled(self):
+        return False
+
+    def exception(self):
+        return None
+
+    def result(self):
+        return self._result
+
+
+class Later(command.Command):
+    summary = "Later"
+
+    def do(self, args):
+        self.stdout.write('later\n')
+        self.future = FakeFuture()
+        return self.future
+
+
+class TimingsCommand(command.Command):
+    summary = "Timings command"
+    allowTimings = True
+    lazySubCommands = True
+    subCommandClasses = [Show, Fail, Later]
+
+
+class TimingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.c = TimingsCommand(stdout=self.out, stderr=self.err)
+
+    def testHook(self):
+        timings = []
+
+        def hook(c, phase, wall, cpu):
+            timings.append((c.name, phase))
+            self.failUnless(wall >= 0)
+
+        self.c.addTimingHook(hook)
+        self.assertEquals(self.c.parse(['show']), 0)
+        self.assertEquals(timings, [
+            ('timingscommand', 'parser'),
+            ('timingscommand', 'parse_args'),
+            ('timingscommand', 'handleOptions'),
+            ('timingscommand', 'lookup'),
+            ('show', 'construct'),
+            ('show', 'parser'),
+            ('show', 'parse_args'),
+            ('show', 'handleOptions'),
+            ('show', 'do'),
+        ])
+
+        self.c.removeTimingHook(hook)
+        self.c.parse(['show'])
+        self.assertEquals(len(timings), 9)
+
+    def testTable(self):
+        self.assertEquals(self.c.parse(['--timings', 'show']), 0)
+        lines = self.err.getvalue().split('\n')
+        self.assertEquals(lines[0], 'Timings:')
+        self.assertEquals(lines[1].split()[:2], ['command', 'phase'])
+        self.assertEquals(lines[3].split()[:2], ['timingscommand',
+            'parse_args'])
+        self.assertEquals(lines[-2].split()[:3], ['timingscommand', 'show',
+            'do'])
+
+    def testJSON(self):
+        import json
+        self.assertEquals(self.c.parse(['--timings-json', 'fail']), 3)
+        timings = json.loads(self.err.getvalue().split('\n')[1])
+        self.assertEquals(timings[-1]['command'], 'timingscommand fail')
+        self.assertEquals(timings[-1]['phase'], 'do')
+
+    def testFuture(self):
+        future = self.c.parse(['--timings', 'later'])
+        self.assertEquals(self.err.getvalue(), '')
+        future.set_result(0)
+        lines = self.err.getvalue().split('\n')
+        self.assertEquals(lines[-2].split()[:3], ['timingscommand', 'later',
+            'doLater'])
+
+    def testNoTimings(self):
+        self.c.parse(['show'])
+        self.assertEquals(self.err.getvalue(), '')
+        self.assertEquals(self.c._timingHooks, ())
+
+
+class CountingIO(StringIO.StringIO):
+
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        StringIO.StringIO.write(self, data)
+
+
+class Lines(command.Command):
+    summary = "Lines"
+
+    def do(self, args):
+        for i in range(int(args[0])):
+            self.stdout.write('line %d' % i)
+            self.stdout.write('\n')
+        if args[1:]:
+            raise command.CommandError('error')
+
+
+class BufferedCommand(command.Command):
+    summary = "Buffered command"
+    bufferSize = 1024
+    allowBatch = True
+    subCommandClasses = [Lines, Later]
+
+
+class BufferedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = CountingIO()
+        self.err = CountingIO()
+        self.c = BufferedCommand(stdout=self.out, stderr=self.err)
+
+    def testCoalesced(self):
+        self.assertEquals(self.c.parse(['lines', '10']), 0)
+        self.assertEquals(self.out.writes, 1)
+        self.assertEquals(self.out.getvalue(),
+            ''.join(['line %d\n' % i for i in range(10)]))
+        self.failUnless(self.c._stdout is self.out)
+
+    def testSize(self):
+        self.c.parse(['lines', '1000'])
+        self.failUnless(1 < self.out.writes < 100)
+
+    def testLines(self):
+        self.c.bufferLines = True
+        self.c.parse(['lines', '10'])
+        self.assertEquals(self.out.writes, 10)
+
+    def testCommandExited(self):
+        self.assertEquals(self.c.parse(['lines', '3', 'fail']), 3)
+        self.assertEquals(self.out.writes, 1)
+        self.assertEquals(self.err.getvalue(), 'error\n')
+
+    def testUnicode(self):
+        writer = command.BufferedWriter(command.OutputBuffer(), self.out)
+        writer.write(u'caf\xe9 ')
+        writer.write('caf\xc3\xa9\n')
+        writer.flush()
+        self.assertEquals(self.out.getvalue(), 'caf\xc3\xa9 caf\xc3\xa9\n')
+
+    def testStream(self):
+        writer = command.BufferedWriter(command.OutputBuffer(), sys.stdout)
+        self.assertEquals(writer.isatty(), sys.stdout.isatty())
+        self.assertEquals(writer.fileno(), sys.stdout.fileno())
+        self.assertEquals(writer.encoding, sys.stdout.encoding)
+
+    def testFuture(self):
+        future = self.c.parse(['later'])
+        self.assertEquals(self.out.getvalue(), '')
+        self.failIf(self.c._outputBuffer is None)
+        future.set_result(0)
+        self.assertEquals(self.out.getvalue(), 'later\n')
+        self.failUnless(self.c._stdout is self.out)
+
+    def testBatch(self):
+        self.c.parseBatch(['lines 2', 'lines 3'])
+        self.assertEquals(self.out.getvalue(),
+            'line 0\nline 1\nline 0\nline 1\nline 2\n')
+
+
+class Export(command.Command):
+    summary = "Export"
+
+    def do(self, args):
+        self.seen = []
+        for i in range(int(args[0])):
+            self.seen.append(self.stdout.getvalue())
+            yield 'row %d' % i
+        yield u'caf\xe9'
+        yield 3
+        if args[1:]:
+            raise command.CommandError('export failed')
+
+
+class StreamCommand(command.Command):
+    summary = "Stream command"
+    subCommandClasses = [Export, ]
+
+
+class StreamingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.c = StreamCommand(stdout=self.out, stderr=self.err)
+
+    def testStream(self):
+        self.assertEquals(self.c.parse(['export', '2']), 0)
+        self.assertEquals(self.out.getvalue(),
+            'row 0\nrow 1\ncaf\xc3\xa9\n3\n')
+
+    def testIncremental(self):
+        # items are written as they are produced, not when do() is done
+        self.c.parse(['export', '3'])
+        self.assertEquals(self.c.getSubCommand('export').seen,
+            ['', 'row 0\n', 'row 0\nrow 1\n'])
+
+    def testExited(self):
+        self.assertEquals(self.c.parse(['export', '1', 'fail']), 3)
+        self.assertEquals(self.out.getvalue(), 'row 0\ncaf\xc3\xa9\n3\n')
+        self.assertEquals(self.err.getvalue(), 'export failed\n')
+
+
+class Records(command.Command):
+    summary = "Records"
+
+    def do(self, args):
+        self.emit({'name': u'caf\xe9', 'size': 3})
+        if args:
+            raise command.CommandError(args[0])
+        yield {'name': 'b', 'size': 4}
+
+
+class PrintHelp(command.Command):
+    summary = "Print help"
+
+    def do(self, args):
+        self.parser.print_help()
+
+
+class StructuredCommand(command.Command):
+    summary = "Structured command"
+    allowJSON = True
+    allowBatch = True
+    subCommandClasses = [Records, PrintHelp]
+
+
+class StructuredTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.c = StructuredCommand(stdout=self.out, stderr=self.err)
+
+    def records(self):
+        import json
+        return [json.loads(l) for l in self.out.getvalue().splitlines()]
+
+    def testHuman(self):
+        self.assertEquals(self.c.parse(['records']), 0)
+        self.assertEquals(self.out.getvalue(),
+            'name=caf\xc3\xa9 size=3\nname=b size=4\n')
+
+    def testJSON(self):
+        self.assertEquals(self.c.parse(['--json', 'records']), 0)
+        self.assertEquals(self.records(), [
+            {'name': u'caf\xe9', 'size': 3},
+            {'name': 'b', 'size': 4},
+            {'exit': 0},
+        ])
+
+    def testError(self):
+        self.assertEquals(self.c.parse(['--json', 'records', 'broken']), 3)
+        self.assertEquals(self.records(), [
+            {'name': u'caf\xe9', 'size': 3},
+            {'error': 'broken', 'status': 3},
+            {'exit': 3},
+        ])
+        self.assertEquals(self.err.getvalue(), '')
+
+    def testOptionError(self):
+        self.assertEquals(self.c.parse(['--json', 'records', '--bogus']), 3)
+        self.assertEquals(self.records(), [
+            {'error': 'no such option: --bogus', 'status': 3},
+            {'exit': 3},
+        ])
+        self.assertEquals(self.c._structured, None)
+
+    def testHumanOptionError(self):
+        self.assertRaises(command.CommandError, self.c.parse,
+            ['records', '--bogus'])
+        self.assertEquals(self.c._structured, None)
+
+    def testHelp(self):
+        self.assertEquals(self.c.parse(['--json', '--help']), None)
+        records = self.records()
+        self.assertEquals(len(records), 2)
+        self.assertEquals(records[1], {'exit': 0})
+        self.failUnless(records[0]['output'].find('records') > -1)
+
+        self.out.truncate(0)
+        self.assertEquals(self.c.parse(['--json', 'records', '--help']), None)
+        records = self.records()
+        self.assertEquals(len(records), 2)
+        self.assertEquals(records[1], {'exit': 0})
+        self.failUnless(records[0]['output'].lower().find(
+            'usage: structuredcommand records') > -1)
+
+    def testHelpCommand(self):
+        self.assertEquals(self.c.parse(['--json', 'help']), 0)
+        records = self.records()
+        self.assertEquals(len(records), 2)
+        self.failUnless(records[0]['output'].find('records') > -1)
+        self.assertEquals(self.err.getvalue(), '')
+
+    def testPrintHelp(self):
+        # the parser writes to stdout again after parsing
+        self.assertEquals(self.c.parse(['printhelp']), 0)
+        self.failUnless(self.out.getvalue().lower().startswith('usage:'))
+
+    def testHumanHelp(self):
+        self.assertEquals(self.c.parse(['--help']), None)
+        self.failUnless(self.out.getvalue().lower().startswith('usage:'))
+
+    def testBatch(self):
+        path = tempfile.mktemp()
+        handle = open(path, 'w')
+        handle.write('records\nrecords --bogus\n')
+        handle.close()
+        try:
+            self.assertEquals(self.c.parse(['--json', '--batch', path]), 3)
+        finally:
+            os.unlink(path)
+        self.assertEquals(self.records(), [
+            {'name': u'caf\xe9', 'size': 3},
+            {'name': 'b', 'size': 4},
+            {'error': 'no such option: --bogus', 'status': 3},
+            {'exit': 3},
+        ])
+
+    def testHumanError(self):
+        self.assertEquals(self.c.parse(['records', 'broken']), 3)
+        self.assertEquals(self.err.getvalue(), 'broken\n')
+
+
+class FakeLogger(object):
+
+    def __init__(self, level):
+        self.level = level
+        self.messages = []
+
+    def isEnabledFor(self, level):
+        return level >= self.level
+
+    def debug(self, format, *args):
+        self.messages.append(format % args)
+
+
+class LoggingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.calls = []
+        self.c = FakeSubSubCommand()
+
+    def expensive(self):
+        self.calls.append(None)
+        return 'expensive'
+
+    def testDisabled(self):
+        self.c.logger = FakeLogger(command.INFO)
+        self.c.debug('%s', command.Lazy(self.expensive))
+        self.assertEquals(self.calls, [])
+        self.assertEquals(self.c.logger.messages, [])
+
+    def testEnabled(self):
+        self.c.logger = FakeLogger(command.DEBUG)
+        self.c.debug('%s', command.Lazy(self.expensive))
+        self.assertEquals(self.calls, [None, ])
+        self.assertEquals(self.c.logger.messages, ['expensive', ])
+
+    def testParse(self):
+        self.c.logger = FakeLogger(command.DEBUG)
+        self.c._stdout = StringIO.StringIO()
+        self.c.parse(['--help'])
+        self.failUnless(self.c.logger.messages[0].startswith('calling <'))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+# -*- Mode: Python; test-case-name: test_completion -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import os
+import shutil
+import tempfile
+import unittest
+import subprocess
+import StringIO
+
+from command import completion
+
+from test import test_command
+
+
+class CompletionRoot(test_command.CompletionCommand):
+    subCommandClasses = test_command.CompletionCommand.subCommandClasses + [
+        completion.Completion]
+
+
+class GenerateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'prog.bash')
+        handle = open(self.path, 'w')
+        handle.write(completion.generate(CompletionRoot(), 'bash', 'prog'))
+        handle.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        unittest.TestCase.tearDown(self)
+
+    def complete(self, words):
+        # complete the last of the words like bash would
+        script = 'source %s; COMP_WORDS=(prog %s); COMP_CWORD=%d; ' \
+            '_prog; echo "${COMPREPLY[@]}"' % (
+                self.path, ' '.join(["'%s'" % w for w in words]), len(words))
+        process = subprocess.Popen(['bash', '-c', script],
+            stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        return output.split()
+
+    def testNames(self):
+        self.assertEquals(self.complete(['c']),
+            ['completion', 'config', 'connect'])
+        self.assertEquals(self.complete(['l']), ['link', 'log'])
+
+    def testNested(self):
+        self.assertEquals(self.complete(['config', 's']), ['set', 'show'])
+        self.assertEquals(self.complete(['unknown', '']), [])
+
+    def testOptions(self):
+        self.assertEquals(self.complete(['log', '--']),
+            ['--help', '--level', '--verbose'])
+        self.assertEquals(self.complete(['log', '--level', 'x', '-v']),
+            ['-v'])
+
+    def testSameAsShell(self):
+        c = CompletionRoot()
+        for words in (['config', 'sh'], ['--'], ['link', '-'], ['']):
+            self.assertEquals(self.complete(words),
+                c.getCompletions(words[:-1], words[-1]))
+
+    def testZsh(self):
+        script = completion.generate(CompletionRoot(), 'zsh', 'my-prog')
+        self.failUnless(script.startswith('#compdef my-prog\n'))
+        self.failUnless('_my_prog "$@"' in script)
+
+    def testUnknownShell(self):
+        self.assertRaises(KeyError, completion.generate, CompletionRoot(),
+            'csh')
+
+
+class CompletionCommandTestCase(unittest.TestCase):
+
+    def testCommand(self):
+        out = StringIO.StringIO()
+        c = CompletionRoot(stdout=out)
+        self.assertEquals(c.parse(['completion', '-p', 'prog', 'bash']), 0)
+        self.failUnless(out.getvalue().endswith('complete -F _prog prog\n'))
+
+    def testNoShell(self):
+        err = StringIO.StringIO()
+        c = CompletionRoot(stderr=err)
+        self.assertEquals(c.parse(['completion']), 3)
+        self.assertEquals(err.getvalue(), 'Please specify one of bash, zsh.\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# -*- Mode: Python; test-case-name: test_daemon -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import os
+import json
+import shutil
+import signal
+import socket
+import tempfile
+import unittest
+import StringIO
+
+from command import command, daemon
+
+
+class Cwd(command.Command):
+    summary = "Show the working directory"
+
+    def do(self, args):
+        self.stdout.write(os.getcwd() + '\n')
+        self.stderr.write(os.environ.get('DAEMONTEST', '') + '\n')
+        return 4
+
+
+class DaemonCommand(command.Command):
+    summary = "Daemon command"
+    subCommandClasses = [Cwd, ]
+
+
+class HandleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.server = daemon.Server(DaemonCommand(), None,
+            environment=['DAEMONTEST', ])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        unittest.TestCase.tearDown(self)
+
+    def testHandle(self):
+        client, server = socket.socketpair()
+        daemon._send(client, daemon.REQUEST, json.dumps({
+            'argv': ['cwd', ],
+            'cwd': self.dir,
+            'env': {'DAEMONTEST': 'set'},
+        }))
+        cwd = os.getcwd()
+        self.server.handle(server)
+        self.assertEquals(os.getcwd(), cwd)
+        self.failIf('DAEMONTEST' in os.environ)
+
+        self.assertEquals(daemon._recv(client),
+            (daemon.STDOUT, self.dir + '\n'))
+        self.assertEquals(daemon._recv(client), (daemon.STDERR, 'set\n'))
+        self.assertEquals(daemon._recv(client), (daemon.EXIT, '4'))
+
+    def testStreamsRestored(self):
+        out = StringIO.StringIO()
+        self.server.root._stdout = out
+        client, server = socket.socketpair()
+        daemon._send(client, daemon.REQUEST, json.dumps({
+            'argv': ['cwd', ], 'cwd': self.dir, 'env': {},
+        }))
+        self.server.handle(server)
+        self.failUnless(self.server.root._stdout is out)
+
+    def testOptionError(self):
+        client, server = socket.socketpair()
+        daemon._send(client, daemon.REQUEST, json.dumps({
+            'argv': ['cwd', '--bogus'], 'cwd': self.dir, 'env': {},
+        }))
+        self.server.handle(server)
+
+        messages = []
+        while True:
+            message = daemon._recv(client)
+            messages.append(message)
+            if message[0] == daemon.EXIT:
+                break
+        self.assertEquals(messages[-1], (daemon.EXIT, '3'))
+        err = ''.join([d for k, d in messages if k == daemon.STDERR])
+        self.failUnless(err.endswith('no such option: --bogus\n'))
+        self.failIf('Traceback' in err)
+
+    def testEnvironment(self):
+        self.server.environment = []
+        client, server = socket.socketpair()
+        daemon._send(client, daemon.REQUEST, json.dumps({
+            'argv': ['cwd', ],
+            'cwd': self.dir,
+            'env': {'DAEMONTEST': 'set'},
+        }))
+        self.server.handle(server)
+
+        daemon._recv(client)
+        self.assertEquals(daemon._recv(client), (daemon.STDERR, '\n'))
+
+
+class ServeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'socket')
+        server = daemon.Server(DaemonCommand(), self.path, workers=2,
+            environment=['DAEMONTEST', ])
+        server.listen()
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                server.serve()
+            finally:
+                os._exit(0)
+
+    def tearDown(self):
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        shutil.rmtree(self.dir)
+        unittest.TestCase.tearDown(self)
+
+    def testCall(self):
+        out = StringIO.StringIO()
+        err = StringIO.StringIO()
+        os.environ['DAEMONTEST'] = 'forwarded'
+        try:
+            ret = daemon.call(self.path, ['cwd', ], out, err,
+                environment=['DAEMONTEST', ])
+        finally:
+            del os.environ['DAEMONTEST']
+        self.assertEquals(ret, 4)
+        self.assertEquals(out.getvalue(), os.getcwd() + '\n')
+        self.assertEquals(err.getvalue(), 'forwarded\n')
+
+        ret = daemon.call(self.path, ['unknown', ], out, err)
+        self.assertEquals(ret, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+# -*- Mode: Python; test-case-name: test_manholecmd -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import re
+import unittest
+
+try:
+    from twisted.internet import defer
+    from command import manholecmd
+except ImportError:
+    manholecmd = None
+
+from command import command
+
+
+class Terminal:
+    """
+    I am the part of a terminal that manholes write to.
+    """
+
+    def __init__(self):
+        self.written = []
+        self.lastWrite = ''
+
+    def write(self, data):
+        self.written.append(data)
+        self.lastWrite = data
+
+    def nextLine(self):
+        self.write('\n')
+
+    def eraseLine(self):
+        self.written.append('<erase>')
+
+    def cursorBackward(self, n):
+        self.written.append('<back %d>' % n)
+
+    def getvalue(self):
+        return ''.join([w for w in self.written if not w.startswith('<')])
+
+
+class Handler:
+    """
+    I am the part of a manhole that interpreters use.
+    """
+
+    def __init__(self):
+        self.terminal = Terminal()
+        self.ps = None
+
+
+class Show(command.Command):
+    summary = "Show"
+
+    def do(self, args):
+        self.stdout.write('shown %s\n' % ' '.join(args))
+
+
+class Root(command.Command):
+    summary = "Root"
+    subCommandClasses = [Show]
+
+
+class CmdInterpreterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        if not manholecmd:
+            raise unittest.SkipTest('no Twisted')
+        self.root = Root()
+        self.created = created = []
+        cmdClass = command.commandToCmdClass(self.root)
+
+        class Cmd(cmdClass):
+            prompt = 'root> '
+
+            def __init__(self, *args, **kwargs):
+                created.append(self)
+                cmdClass.__init__(self, *args, **kwargs)
+
+        class Interpreter(manholecmd.CmdInterpreter):
+            cmdClass = Cmd
+
+        self.handler = Handler()
+        self.interpreter = Interpreter(self.handler)
+
+    def testReuse(self):
+        self.assertEquals(self.handler.ps, ('root> ', '... '))
+        for args in ('a', 'b', 'c'):
+            results = []
+            d = self.interpreter.push('show %s' % args)
+            d.addCallback(results.append)
+            self.assertEquals(results, [0])
+        self.assertEquals(len(self.created), 1)
+        self.assertEquals(self.handler.terminal.getvalue(),
+            'shown a\nshown b\nshown c\n')
+        self.failUnless(self.root._stdout is self.handler.terminal)
+
+    def testNewTerminal(self):
+        first = self.handler.terminal
+        self.interpreter.push('show a')
+        self.handler.terminal = Terminal()
+        self.interpreter.push('show b')
+        self.assertEquals(len(self.created), 1)
+        self.assertEquals(first.getvalue(), 'shown a\n')
+        self.assertEquals(self.handler.terminal.getvalue(), 'shown b\n')
+        self.failUnless(self.created[0].stdout is self.handler.terminal)
+
+
+class Output:
+    """
+    I collect the output of a FileWrapper.
+    """
+
+    def __init__(self):
+        self.added = []
+
+    def addOutput(self, data, async=False):
+        self.added.append(data)
+
+
+class FileWrapperTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        if not manholecmd:
+            raise unittest.SkipTest('no Twisted')
+
+    def testFlush(self):
+        output = Output()
+        wrapper = manholecmd.FileWrapper(output)
+        wrapper.write('a\r\n')
+        wrapper.writelines(['b', '\r', '\nc'])
+        self.assertEquals(output.added, [])
+        wrapper.flush()
+        wrapper.flush()
+        self.assertEquals(output.added, ['a\nb\nc'])
+
+    def testSize(self):
+        output = Output()
+        wrapper = manholecmd.FileWrapper(output)
+        wrapper.size = 4
+        wrapper.write('ab')
+        wrapper.write('cd')
+        wrapper.write('e')
+        self.assertEquals(output.added, ['abcd'])
+
+
+class AddOutputTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        if not manholecmd:
+            raise unittest.SkipTest('no Twisted')
+        self.manhole = manholecmd.Manhole()
+        self.manhole.terminal = self.terminal = Terminal()
+        self.manhole.lineBuffer = []
+        self.manhole.mode = 'insert'
+
+    def tearDown(self):
+        if manholecmd:
+            # cancels the call to flushOutput()
+            self.manhole.flushOutput()
+        unittest.TestCase.tearDown(self)
+
+    def testCoalesce(self):
+        for i in range(3):
+            self.manhole.addOutput('line %d' % i, async=True)
+        self.assertEquals(self.terminal.written, [])
+        self.failUnless(self.manhole._asyncOutputCall.active())
+
+        call = self.manhole._asyncOutputCall
+        self.manhole.flushOutput()
+        self.failIf(call.active())
+        self.assertEquals(self.terminal.written,
+            ['<erase>', '<back 4>', 'line 0\nline 1\nline 2', '\n', '>>> '])
+
+    def testSize(self):
+        self.manhole.outputBufferSize = 10
+        self.manhole.addOutput('12345', async=True)
+        self.manhole.addOutput('67890\n', async=True)
+        self.assertEquals(self.terminal.getvalue(), '12345\n67890\n>>> ')
+        self.assertEquals(self.manhole._asyncOutputCall, None)
+
+    def testOrder(self):
+        self.manhole.addOutput('later', async=True)
+        self.manhole.addOutput('now\n')
+        self.assertEquals(self.terminal.getvalue(), 'later\n>>> now\n')
+
+    def testLineBuffer(self):
+        self.manhole.lineBuffer = list('typed')
+        self.manhole.lineBufferIndex = 5
+        self.manhole.addOutput('done', async=True)
+        self.manhole.flushOutput()
+        self.assertEquals(self.terminal.getvalue(), 'done\n>>> typed')
+        self.assertEquals(self.manhole.lineBuffer, list('typed'))
+
+
+class PendingDeferredsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        if not manholecmd:
+            raise unittest.SkipTest('no Twisted')
+        self.output = Output()
+        self.interpreter = manholecmd.ManholeInterpreter(self.output)
+        self.interpreter.maxPendingDeferreds = 2
+        self.deferreds = []
+        for i in range(3):
+            d = defer.Deferred()
+            self.interpreter.locals['d%d' % i] = d
+            self.deferreds.append(d)
+            self.interpreter.push('d%d' % i)
+
+    def push(self, line):
+        del self.output.added[:]
+        self.interpreter.push(line)
+        return self.output.added
+
+    def testDisplay(self):
+        self.assertEquals(self.output.added,
+            ['<Deferred #0>', '<Deferred #1>', '<Deferred #2>'])
+        self.assertEquals(self.push('d1'), ['<Deferred #1>'])
+
+    def testCap(self):
+        lines = self.push('pendingDeferreds()')[0].split('\n')
+        self.assertEquals(len(lines), 2)
+        self.failUnless(re.match(r'^#1 +\d+\.\d{3} s  d1$', lines[0]),
+            lines[0])
+        self.failUnless(re.match(r'^#2 +\d+\.\d{3} s  d2$', lines[1]),
+            lines[1])
+
+        # a forgotten one still reports, but leaves the others alone
+        self.deferreds[0].callback(None)
+        self.assertEquals(len(self.interpreter._pendingDeferreds), 2)
+
+    def testLatency(self):
+        self.deferreds[2].callback(5)
+        self.failUnless(re.match(
+            r'^Deferred #2 called back after \d+\.\d{3} s: 5$',
+            self.output.added[-1]), self.output.added[-1])
+        self.assertEquals(self.deferreds[2].result, 5)
+        lines = self.push('pendingDeferreds()')[0].split('\n')
+        self.assertEquals(len(lines), 1)
+
+    def testCancel(self):
+        added = self.push('cancelDeferred(1)')
+        self.assertEquals(len(added), 1)
+        self.failUnless(re.match(r'^Deferred #1 failed after \d+\.\d{3} s: ',
+            added[0]), added[0])
+        self.deferreds[1].addErrback(lambda f: f.trap(defer.CancelledError))
+
+        self.assertEquals(self.push('cancelDeferred(1)'),
+            ['No pending Deferred #1.'])
+        self.push('cancelDeferred(2)')
+        self.deferreds[2].addErrback(lambda f: f.trap(defer.CancelledError))
+        self.assertEquals(self.push('pendingDeferreds()'),
+            ['No pending Deferreds.'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- Mode: Python; test-case-name: test_pool -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import os
+import tempfile
+import unittest
+import StringIO
+
+from command import command, pool
+
+
+class Pid(command.Command):
+    summary = "Show the process id"
+
+    def do(self, args):
+        if args[0] == 'exit':
+            raise SystemExit('exited')
+        self.stdout.write('%s\n' % args[0])
+        self.stderr.write('%d\n' % os.getpid())
+        return int(args[0]) % 2
+
+
+class PoolCommand(command.Command):
+    summary = "Pool command"
+    allowBatch = True
+    subCommandClasses = [Pid, ]
+
+
+class BatchPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.pool = pool.BatchPool(PoolCommand(), processes=2)
+
+    def testOrdered(self):
+        lines = ['pid %d' % i for i in range(20)]
+        rets = self.pool.run(lines + ['', '# comment'],
+            stdout=self.out, stderr=self.err)
+        self.assertEquals(rets, [(l, i % 2) for i, l in enumerate(lines)])
+        self.assertEquals(self.out.getvalue(),
+            ''.join(['%d\n' % i for i in range(20)]))
+        pids = self.err.getvalue().split()
+        self.failIf(str(os.getpid()) in pids)
+
+    def testUnordered(self):
+        lines = ['pid %d' % i for i in range(20)]
+        rets = self.pool.run(lines, ordered=False,
+            stdout=self.out, stderr=self.err)
+        self.assertEquals(rets, [(l, i % 2) for i, l in enumerate(lines)])
+        self.assertEquals(sorted(self.out.getvalue().split()),
+            sorted([str(i) for i in range(20)]))
+
+    def testJobsOption(self):
+        path = tempfile.mktemp()
+        handle = open(path, 'w')
+        handle.write('pid 2\npid 3\npid 4\n')
+        handle.close()
+        c = PoolCommand(stdout=self.out, stderr=self.err)
+        try:
+            self.assertEquals(c.parse(['--batch', path, '--jobs', '2']), 1)
+        finally:
+            os.unlink(path)
+        self.assertEquals(self.out.getvalue(), '2\n3\n4\n')
+        self.failUnless(self.err.getvalue().endswith(
+            "'pid 3' exited with 1.\n"))
+
+    def testErrors(self):
+        # the same as running the lines one by one
+        lines = ['pid 2', 'pid --bogus', 'pid exit']
+        rets = self.pool.run(lines, stdout=self.out, stderr=self.err)
+        self.assertEquals(rets, [('pid 2', 0), ('pid --bogus', 3),
+            ('pid exit', 1)])
+        err = StringIO.StringIO()
+        self.assertEquals(PoolCommand(stderr=err).parseBatch(lines[1:2]),
+            [('pid --bogus', 3)])
+        self.failUnless(self.err.getvalue().find(err.getvalue()) > -1)
+        self.failUnless(self.err.getvalue().endswith('exited\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
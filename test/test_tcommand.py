@@ -0,0 +1,158 @@
+# -*- Mode: Python; test-case-name: test_tcommand -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+import unittest
+import StringIO
+
+try:
+    from twisted.internet import defer, selectreactor
+    from command import tcommand
+except ImportError:
+    tcommand = None
+
+from command import command
+
+
+if tcommand:
+
+    class Reactor(selectreactor.SelectReactor):
+        """
+        I am a reactor for a single test; the global one can only run
+        once per process.
+        """
+
+        def run(self):
+            # leave the signal handlers of the process alone
+            selectreactor.SelectReactor.run(self, installSignalHandlers=False)
+
+    class Later(tcommand.TwistedCommand):
+        summary = "Exit with the given code, later"
+
+        def doLater(self, args):
+            d = defer.Deferred()
+            reactor = self.getRootCommand().reactor
+            if args[0] == 'fail':
+                reactor.callLater(0, d.errback,
+                    command.CommandError('bad thing'))
+            else:
+                reactor.callLater(0, d.callback, int(args[0]))
+            return d
+
+    class Now(command.Command):
+        summary = "Exit with 5"
+
+        def do(self, args):
+            return 5
+
+    class Root(tcommand.ReactorCommand):
+        summary = "Root"
+        subCommandClasses = [Later, Now]
+
+        def installReactor(self, reactor=None):
+            if not self.reactor:
+                self.reactor = Reactor()
+
+
+class ReactorCommandTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        if not tcommand:
+            raise unittest.SkipTest('no Twisted')
+        self.out = StringIO.StringIO()
+        self.err = StringIO.StringIO()
+        self.c = Root(stdout=self.out, stderr=self.err)
+        self.c.installReactor()
+        # fail instead of hanging
+        self.c.reactor.callLater(5, self.c.reactor.stop)
+
+    def testParse(self):
+        self.assertEquals(self.c.parse(['later', '3']), 3)
+        self.failIf(self.c.reactor.running)
+
+    def testStartReactor(self):
+        rets = []
+
+        def main(*args):
+            self.assertEquals(args, (1, ))
+            self.assertEquals(self.c.parse(['now']), 5)
+            d = defer.gatherResults([
+                self.c.parse(['later', '1']),
+                self.c.parse(['later', 'fail']),
+                self.c.parse(['later', '2']),
+            ])
+            d.addCallback(rets.extend)
+            self.assertEquals(len(self.c._pending), 3)
+            return self.c.stopReactor()
+
+        self.c.startReactor(main, 1)
+        self.assertEquals(rets, [1, 3, 2])
+        self.assertEquals(self.c._pending, [])
+        self.assertEquals(self.err.getvalue(), 'bad thing\n')
+
+
+class DoLaterManyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        if not tcommand:
+            raise unittest.SkipTest('no Twisted')
+        self.err = StringIO.StringIO()
+        self.c = Later(stderr=self.err)
+        self.running = {}
+        self.peak = 0
+
+    def call(self, item):
+        d = defer.Deferred()
+        self.running[item] = d
+        self.peak = max(self.peak, len(self.running))
+        return d
+
+    def fire(self, item, result=None):
+        d = self.running.pop(item)
+        if isinstance(result, Exception):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def testConcurrency(self):
+        results = []
+        d = self.c.doLaterMany(['a', 'b', 'c', 'd'], self.call, 2)
+        d.addCallback(results.extend)
+        self.assertEquals(sorted(self.running.keys()), ['a', 'b'])
+        self.fire('b', 2)
+        self.assertEquals(sorted(self.running.keys()), ['a', 'c'])
+        self.fire('a', 1)
+        self.fire('c', command.CommandOk('ok'))
+        self.fire('d', 4)
+        self.assertEquals(self.peak, 2)
+        self.assertEquals(results, [('a', True, 1), ('b', True, 2),
+            ('c', True, 'ok'), ('d', True, 4)])
+        self.assertEquals(self.c.checkResults(results), results)
+        self.assertEquals(self.err.getvalue(), '')
+
+    def testFailures(self):
+        results = []
+        d = self.c.doLaterMany(['a', 'b', 'c'], self.call)
+        d.addCallback(results.extend)
+        self.assertEquals(self.peak, 3)
+        self.fire('a', KeyError('a'))
+        self.fire('b', 2)
+        self.fire('c', command.CommandError('bad thing'))
+        self.assertEquals([r[:2] for r in results],
+            [('a', False), ('b', True), ('c', False)])
+
+        # the first failure, not a CommandExited, decides the status
+        try:
+            self.c.checkResults(results)
+        except command.CommandExited, e:
+            self.assertEquals(e.status, 1)
+            self.assertEquals(e.output, '2 of 3 failed.')
+        else:
+            self.fail('checkResults did not raise')
+        self.assertEquals(self.err.getvalue(),
+            "a: 'a'\nc: bad thing\n")
+
+
+if __name__ == '__main__':
+    unittest.main()